@@ -4,14 +4,45 @@ if sys.version_info[0] < 3:
 else:
     import configparser
 import argparse
+import binascii
 import io
 import hashlib
+import errno
+import heapq
+import json
+import mmap
 import os.path
+import re
+import select
 import shutil
+import stat as statmod
+import struct
 import subprocess
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
 
 
 ROOT_KEY = '<root>'
+STATE_HEADER_DIGEST = '# digest: '
+STATE_BINARY_MAGIC = b'PRJSTATE'
+STATE_BINARY_VERSION = 2
+STATE_RECORD_HAS_STAT = 0x01
+STATE_FORMAT_BINARY = 'binary'
+STATE_FORMAT_TEXT = 'text'
+STATE_FORMATS = [STATE_FORMAT_BINARY, STATE_FORMAT_TEXT]
+STATE_FORMAT = STATE_FORMAT_BINARY
+_STATE_BINARY_HEADER = struct.Struct('<8sHBB')
+_STATE_BINARY_COUNT = struct.Struct('<Q')
+_STATE_BINARY_RECORD = struct.Struct('<HHcB')
+_STATE_BINARY_STAT = struct.Struct('<QqQ')
+_STATE_BINARY_LAYOUT = struct.Struct('<QQQQQ')
+_STATE_BINARY_OFFSET = struct.Struct('<Q')
+_STATE_BINARY_KEY_SPAN = struct.Struct('<QQ')
+_STATE_BINARY_ENTRY = struct.Struct('<cB')
+STATE_DELTA_MAGIC = b'PRJDELTA'
+STATE_DELTA_VERSION = 1
+_STATE_DELTA_RECORD = struct.Struct('<ccI')
 TYPE_DIR = 'd'
 TYPE_FILE = 'f'
 TYPE_SYMLINK = 's'
@@ -22,6 +53,23 @@ CHANGE_STATUS_ITEM_DELETED  = 0x0004
 CHANGE_STATUS_SEEDING       = 0x0008
 CHANGE_STATUS_INHERITED     = 0x0010
 
+OUTPUT_TEXT = 'text'
+OUTPUT_JSONL = 'jsonl'
+OUTPUTS = [OUTPUT_TEXT, OUTPUT_JSONL]
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+EXCLUDE_FILE = 0x01
+EXCLUDE_DIR = 0x02
+EXCLUDE_ANY = EXCLUDE_FILE | EXCLUDE_DIR
+
+DEFAULT_DIGEST_ALGORITHM = 'md5'
+XXHASH_ALGORITHMS = ('xxh32', 'xxh64', 'xxh128', 'xxh3_64', 'xxh3_128')
+DIGEST_ALGORITHM = DEFAULT_DIGEST_ALGORITHM
+_digest_factory = hashlib.md5
+
+RACY_MTIME_WINDOW_NS = 2 * 1000000000
+
 
 def _to_string(v):
     if sys.version_info[0] < 3:
@@ -40,50 +88,127 @@ def _from_string(v):
     return v.encode('utf-8')
 
 
+def _to_utf8(v):
+    if isinstance(v, bytes):
+        return v
+    return v.encode('utf-8')
+
+
+def make_digest_factory(name):
+    if name in XXHASH_ALGORITHMS:
+        try:
+            import xxhash
+        except ImportError:
+            raise Exception("Digest algorithm '{}' requires the 'xxhash' module.".format(name))
+        return getattr(xxhash, name)
+    try:
+        hashlib.new(name).hexdigest()
+    except (ValueError, TypeError):
+        raise Exception("Digest algorithm '{}' is not supported by this Python.".format(name))
+    factory = getattr(hashlib, name, None)
+    if factory is None:
+        factory = lambda: hashlib.new(name)
+    return factory
+
+
+def set_digest_algorithm(name):
+    global DIGEST_ALGORITHM
+    global _digest_factory
+    _digest_factory = make_digest_factory(name)
+    DIGEST_ALGORITHM = name
+
+
+def new_digest():
+    return _digest_factory()
+
+
+def set_state_format(name):
+    if name not in STATE_FORMATS:
+        raise Exception("Unknown state format '{}', expected one of: {}.".format(name, ', '.join(STATE_FORMATS)))
+    global STATE_FORMAT
+    STATE_FORMAT = name
+
+
+def _intern(v):
+    if sys.version_info[0] < 3:
+        if isinstance(v, unicode):
+            return v
+        return intern(v)
+    return sys.intern(v)
+
+
 def is_item_type_recursive(tp_name):
     return (tp_name == TYPE_DIR)
 
 
-class FileTreeNode:
-    def __init__(self, name, parent_key = None):
-        self.node_name = name
-        if (parent_key is None) or (parent_key == ROOT_KEY):
-            self.node_key = name
-        else:
-            self.node_key = '/'.join([parent_key, name])
-        self.children = {}
+class FileTreeNode(object):
+    __slots__ = ('node_name', 'parent', 'children')
+
+    def __init__(self, name, parent=None):
+        self.node_name = _intern(name)
+        self.parent = parent
+        self.children = None
+
+    @property
+    def node_key(self):
+        if self.parent is None:
+            return self.node_name
+        bits = []
+        node = self
+        while node.parent is not None:
+            bits.append(node.node_name)
+            node = node.parent
+        bits.reverse()
+        return '/'.join(bits)
 
     def get_child(self, name):
-        ret = self.children.get(name)
-        if ret is None:
+        children = self.children or []
+        lo, hi = 0, len(children)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if children[mid].node_name < name:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == len(children) or children[lo].node_name != name:
             raise Exception("Node '{}' doesn't have child named '{}'.".format(self.node_key, name))
-        return ret
+        return children[lo]
 
     def add_child(self, name):
-        if name in self.children:
-            raise Exception("Child named '{}' already added in node '{}'.".format(name, self.node_key))
-        self.children[name] = FileTreeNode(name, self.node_key)
+        # children are kept ordered by name, so they have to be added in that order
+        if self.children is None:
+            self.children = []
+        if self.children and self.children[-1].node_name >= name:
+            raise Exception("Child named '{}' added out of order in node '{}'.".format(name, self.node_key))
+        child = FileTreeNode(name, self)
+        self.children.append(child)
+        return child
 
     def select_keys_of_children(self):
-        ret = set()
-        for k in sorted(self.children.keys()):
-            c = self.children[k]
-            ret.add(c.node_key)
-        return ret
+        if not self.children:
+            return []
+        if self.parent is None:
+            prefix = ''
+        else:
+            prefix = self.node_key + '/'
+        return [prefix + c.node_name for c in self.children]
 
 
 def mkfs(nodes):
+    # In sorted key order a parent precedes its children and siblings come by name,
+    # so a single pass appends every node at its final position.
     root = FileTreeNode(ROOT_KEY)
+    dirs = {ROOT_KEY: root}
     for key in sorted(nodes.keys()):
         if key == ROOT_KEY:
             continue
         _a, _b, _c = key.rpartition('/')
-        parent = root
-        subject = _c
-        if _a:
-            for bit in _a.split('/'):
-                parent = parent.get_child(bit)
-        parent.add_child(subject)
+        parent = dirs.get(_a or ROOT_KEY)
+        if parent is None:
+            raise Exception("Parent of item '{}' is missing.".format(key))
+        node = parent.add_child(_c)
+        if is_item_type_recursive(nodes[key].src_type):
+            dirs[key] = node
     return root
 
 
@@ -91,12 +216,24 @@ class ProjectState:
     def __init__(self, nodes):
         if not nodes:
             nodes = {}
-            nodes[ROOT_KEY] = Source(ROOT_KEY, TYPE_DIR, hashlib.md5().hexdigest())
+            nodes[ROOT_KEY] = Source(ROOT_KEY, TYPE_DIR, new_digest().hexdigest())
         self.nodes = nodes
         self.fs = mkfs(nodes)
 
+    def close(self):
+        pass
+
     def write(self, filename):
+        tmp_filename = filename + '.tmp'
+        if STATE_FORMAT == STATE_FORMAT_TEXT:
+            self.write_text(tmp_filename)
+        else:
+            write_state_binary(tmp_filename, self.nodes)
+        replace_file(tmp_filename, filename)
+
+    def write_text(self, filename):
         with io.open(filename, mode='wt', encoding='utf8') as f:
+            f.write(_to_string('{}{}\n'.format(STATE_HEADER_DIGEST, DIGEST_ALGORITHM)))
             f.write(_to_string('{\n'))
             for k in sorted(self.nodes.keys()):
                 f.writelines([_to_string(self.nodes[k]), _to_string('\n')])
@@ -116,136 +253,510 @@ class ProjectState:
         return fs_node.select_keys_of_children()
 
 
-class Source:
-    def __init__(self, archive_path, src_type, digest):
+class Source(object):
+    __slots__ = ('archive_path', 'src_type', '_digest', 'stat')
+
+    def __init__(self, archive_path, src_type, digest, stat=None):
         self.archive_path = archive_path
         self.src_type = src_type
         self.digest = digest
+        self.stat = stat
+
+    @property
+    def digest(self):
+        if isinstance(self._digest, bytes):
+            return binascii.hexlify(self._digest).decode('ascii')
+        return self._digest
+
+    @digest.setter
+    def digest(self, value):
+        if value is None or isinstance(value, (PendingDigest, PendingDirDigest)):
+            self._digest = value
+        else:
+            self._digest = binascii.unhexlify(value)
 
     def __str__(self):
-        return "    '{}' : ('{}', '{}'),".format(self.archive_path, self.src_type, self.digest)
+        if self.stat is None:
+            return "    '{}' : ('{}', '{}'),".format(self.archive_path, self.src_type, self.digest)
+        return "    '{}' : ('{}', '{}', {}, {}, {}),".format(self.archive_path, self.src_type, self.digest, *self.stat)
+
+
+def is_glob_pattern(value):
+    return '*' in value or '?' in value or '[' in value
+
+
+def glob_to_regex(pattern):
+    # Translates a single path component, so '*' and '?' never have a '/' to cross.
+    out = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            while i < n and pattern[i] == '*':
+                i += 1
+            out.append('.*')
+        elif c == '?':
+            out.append('.')
+        elif c == '[':
+            j = i
+            if j < n and pattern[j] in '!^':
+                j += 1
+            if j < n and pattern[j] == ']':
+                j += 1
+            while j < n and pattern[j] != ']':
+                j += 1
+            if j >= n:
+                out.append('\\[')
+            else:
+                body = pattern[i:j].replace('\\', '\\\\')
+                if body[0] in '!^':
+                    body = '^' + body[1:]
+                out.append('[' + body + ']')
+                i = j + 1
+        else:
+            out.append(re.escape(c))
+    return ''.join(out)
+
+
+class PatternNode(object):
+    # Node of the exclusion trie, reached once the path components so far have matched.
+    # Components like '*.o' are kept by suffix, so the usual name patterns never touch a regex.
+    __slots__ = ('literals', 'suffixes', 'suffix_lengths', 'globs', 'any_glob', 'anydepth', 'self_loop', 'excludes')
+
+    def __init__(self, self_loop=False):
+        self.literals = {}
+        self.suffixes = {}
+        self.suffix_lengths = ()
+        self.globs = []
+        self.any_glob = None
+        self.anydepth = None
+        self.self_loop = self_loop
+        self.excludes = 0
+
+    def add_literal(self, name):
+        child = self.literals.get(name)
+        if child is None:
+            child = PatternNode()
+            self.literals[name] = child
+        return child
+
+    def add_glob(self, pattern):
+        suffix = pattern.lstrip('*')
+        if pattern.startswith('*') and not is_glob_pattern(suffix):
+            child = self.suffixes.get(suffix)
+            if child is None:
+                child = PatternNode()
+                self.suffixes[suffix] = child
+                self.suffix_lengths = tuple(sorted(set(len(s) for s in self.suffixes)))
+            return child
+        source = glob_to_regex(pattern)
+        for s, _r, child in self.globs:
+            if s == source:
+                return child
+        child = PatternNode()
+        self.globs.append((source, re.compile(source + r'\Z', re.DOTALL), child))
+        self.any_glob = re.compile('(?:' + '|'.join(s for s, _r, _c in self.globs) + r')\Z', re.DOTALL)
+        return child
+
+    def add_anydepth(self):
+        if self.anydepth is None:
+            self.anydepth = PatternNode(self_loop=True)
+        return self.anydepth
+
+    def collect(self, name, hits):
+        child = self.literals.get(name)
+        if child is not None:
+            hits.append(child)
+        for k in self.suffix_lengths:
+            if k > len(name):
+                break
+            child = self.suffixes.get(name[len(name) - k:])
+            if child is not None:
+                hits.append(child)
+        if self.any_glob is not None and self.any_glob.match(name):
+            for _s, r, child in self.globs:
+                if r.match(name):
+                    hits.append(child)
+
+
+class MatchState(object):
+    # Set of trie nodes active at some directory, with the kinds of entries it excludes.
+    # 'fallback' is the state of any child whose name hits no edge, so most steps allocate nothing.
+    __slots__ = ('nodes', 'loops', 'excludes', 'fallback')
+
+    def __init__(self, nodes, loops, excludes):
+        self.nodes = nodes
+        self.loops = loops
+        self.excludes = excludes
+        self.fallback = None
 
 
 class FSSelector:
     def __init__(self):
-        self._dir_names_to_exclude = set()
-        self._dir_relpaths_to_exclude = set()
-        self._file_names_to_exclude = set()
-        self._file_relpaths_to_exclude = set()
+        self._root = PatternNode()
+        self._states = {}
+        self._start = None
 
     def add_dir_name_to_exclusions(self, dname):
-        self._dir_names_to_exclude.add(dname)
+        self.add_pattern('**/' + dname, EXCLUDE_DIR)
 
     def add_dir_relpath_to_exclusions(self, relpath):
-        self._dir_relpaths_to_exclude.add(relpath)
+        self.add_pattern(relpath, EXCLUDE_DIR)
 
     def add_file_name_to_exclusions(self, fname):
-        self._file_names_to_exclude.add(fname)
+        self.add_pattern('**/' + fname, EXCLUDE_FILE)
 
     def add_file_relpath_to_exclusions(self, relpath):
-        self._file_relpaths_to_exclude.add(relpath)
+        self.add_pattern(relpath, EXCLUDE_FILE)
+
+    def add_pattern(self, pattern, excludes):
+        # gitignore-style: '*', '?' and '[...]' within a component, '**' for any number of them;
+        # a trailing '**' matches everything inside, not the directory itself.
+        bits = []
+        for bit in pattern.split('/'):
+            if bit and not (bit == '**' and bits and bits[-1] == '**'):
+                bits.append(bit)
+        if not bits:
+            raise Exception("Exclusion pattern '{}' is empty.".format(pattern))
+        if bits[-1] == '**':
+            bits[-1:] = ['*', '**']
+        node = self._root
+        for bit in bits:
+            if bit == '**':
+                node = node.add_anydepth()
+            elif is_glob_pattern(bit):
+                node = node.add_glob(bit)
+            else:
+                node = node.add_literal(bit)
+        node.excludes |= excludes
+        self._states = {}
+        self._start = None
+
+    def start(self):
+        # State of the scan root, None when nothing is excluded at all.
+        if self._start is None:
+            self._start = self._state_of([self._root])
+        return self._start
+
+    def step(self, state, name):
+        # State of the child 'name' of a directory in 'state', None once no pattern can match below.
+        hits = []
+        for node in state.nodes:
+            node.collect(name, hits)
+        if not hits:
+            return state.fallback
+        return self._state_of(list(state.loops) + hits)
+
+    def _state_of(self, nodes):
+        closure = []
+        for node in nodes:
+            while node is not None and node not in closure:
+                closure.append(node)
+                node = node.anydepth
+        key = frozenset(closure)
+        state = self._states.get(key)
+        if state is None:
+            live = tuple(n for n in closure if n.literals or n.suffixes or n.globs or n.self_loop)
+            loops = tuple(n for n in closure if n.self_loop)
+            excludes = 0
+            for n in closure:
+                excludes |= n.excludes
+            if not live and not excludes:
+                return None
+            state = MatchState(live, loops, excludes)
+            self._states[key] = state
+            if loops:
+                state.fallback = self._state_of(loops)
+        return state
+
+
+def digest_of_file(path):
+    # Same digest as hash of data.replace(b'\r\n', b'\n').rstrip(b'\r\n'), computed chunk by chunk:
+    # a trailing '\r' is carried into the next chunk so CRLF pairs are never split,
+    # and a trailing run of line breaks is held back until more content follows it.
+    m = new_digest()
+    carry = b''
+    held_tail = b''
+    with io.open(path, mode='rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            data = carry + chunk
+            if data.endswith(b'\r'):
+                carry = b'\r'
+                data = data[:-1]
+            else:
+                carry = b''
+            data = data.replace(b'\r\n', b'\n')
+            body = data.rstrip(b'\r\n')
+            if body:
+                m.update(held_tail)
+                m.update(body)
+                held_tail = data[len(body):]
+            else:
+                held_tail += data
+    return m.hexdigest()
 
-    def dir_in_interest(self, dname, relpath):
-        if dname in self._dir_names_to_exclude:
-            return False
-        if relpath in self._dir_relpaths_to_exclude:
-            return False
-        return True
 
-    def file_in_interest(self, fname, relpath):
-        if fname in self._file_names_to_exclude:
-            return False
-        if relpath in self._file_relpaths_to_exclude:
+def digest_of_string(value):
+    m = new_digest()
+    m.update(_from_string(value))
+    return m.hexdigest()
+
+
+def stat_key_of(st):
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1000000000)
+    return (st.st_size, mtime_ns, st.st_ino)
+
+
+class StatCache:
+    def __init__(self, nodes, scan_started_ns):
+        self._nodes = nodes
+        self._racy_since_ns = scan_started_ns - RACY_MTIME_WINDOW_NS
+
+    def lookup(self, arch_path, stat_key):
+        src = self._nodes.get(arch_path) if self._nodes else None
+        if src is None or src.src_type != TYPE_FILE or src.stat is None:
+            return None
+        if src.stat != stat_key:
+            return None
+        return src.digest
+
+    def cacheable(self, stat_key):
+        return stat_key[1] < self._racy_since_ns
+
+
+def digest_of_digests(digests):
+    dsum = new_digest()
+    for s in digests:
+        dsum.update(s.encode())
+    return dsum.hexdigest()
+
+
+class PendingDigest:
+    def __init__(self, async_result):
+        self._async_result = async_result
+
+    def resolve(self):
+        return self._async_result.get()
+
+    def ready(self):
+        return self._async_result.ready()
+
+
+class PendingDirDigest:
+    def __init__(self, digests):
+        self._digests = digests
+        self._value = None
+
+    def resolve(self):
+        if self._value is None:
+            self._value = digest_of_digests([resolve_digest(d) for d in self._digests])
+            self._digests = None
+        return self._value
+
+
+def resolve_digest(digest):
+    if isinstance(digest, (PendingDigest, PendingDirDigest)):
+        return digest.resolve()
+    return digest
+
+
+class SerialHasher:
+    def file_digest(self, fs_path):
+        return digest_of_file(fs_path)
+
+    def dir_digest(self, digests):
+        return digest_of_digests(digests)
+
+    def resolve(self, outbox):
+        pass
+
+    def close(self):
+        pass
+
+    def terminate(self):
+        pass
+
+
+class NullHasher(SerialHasher):
+    def file_digest(self, fs_path):
+        return None
+
+    def dir_digest(self, digests):
+        return None
+
+
+class PooledHasher:
+    def __init__(self, jobs):
+        self._pool = ThreadPool(jobs)
+
+    def file_digest(self, fs_path):
+        return PendingDigest(self._pool.apply_async(digest_of_file, (fs_path,)))
+
+    def dir_digest(self, digests):
+        return PendingDirDigest(digests)
+
+    def resolve(self, outbox):
+        for src in outbox.values():
+            src.digest = resolve_digest(src.digest)
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def terminate(self):
+        self._pool.terminate()
+        self._pool.join()
+
+
+def make_hasher(jobs):
+    if jobs is None or jobs <= 1:
+        return SerialHasher()
+    return PooledHasher(jobs)
+
+
+class PathEntry(object):
+    # Same interface as os.DirEntry for a path that did not come from a directory listing:
+    # the scan root, or every entry on Pythons without os.scandir.
+    __slots__ = ('name', 'path', '_lstat', '_stat')
+
+    def __init__(self, path, name=None):
+        self.name = name if name is not None else os.path.basename(path)
+        self.path = path
+        self._lstat = None
+        self._stat = None
+
+    def is_symlink(self):
+        if self._lstat is None:
+            self._lstat = os.lstat(self.path)
+        return statmod.S_ISLNK(self._lstat.st_mode)
+
+    def is_dir(self):
+        try:
+            return statmod.S_ISDIR(self.stat().st_mode)
+        except OSError:
             return False
-        return True
 
+    def stat(self):
+        if self._stat is None:
+            self._stat = os.stat(self.path) if self.is_symlink() else self._lstat
+        return self._stat
 
-def make_rel_path(bits, tail):
-    parts = bits[:]
-    parts.append(tail)
-    return '/'.join(parts)
 
+if hasattr(os, 'scandir'):
+    scandir = os.scandir
+else:
+    def scandir(fs_path):
+        return [PathEntry(os.path.join(fs_path, name), name) for name in os.listdir(fs_path)]
 
-def md5_of_file(path):
-    m = hashlib.md5()
-    data = io.FileIO(path).readall().replace(b'\r\n', b'\n').rstrip(b'\r\n')
-    m.update(data)
-    return m.hexdigest()
 
+def make_child_key(key, name):
+    if key == ROOT_KEY:
+        return name
+    return key + '/' + name
 
-def md5_of_string(value):
-    m = hashlib.md5()
-    m.update(_from_string(value))
-    return m.hexdigest()
 
+def fs_type_of(entry):
+    if entry.is_symlink():
+        return TYPE_SYMLINK
+    if entry.is_dir():
+        return TYPE_DIR
+    return TYPE_FILE
 
-def enum_fs_content_recursive(seed, selector, outbox, pathbits):
-    if pathbits:
-        fs_path = os.path.join(seed, *pathbits)
-        if len(pathbits) > 1:
-            parent = '/'.join(pathbits[0:-1])
-        else:
-            parent = ROOT_KEY
-    else:
-        fs_path = seed
-        parent = None
-
-    if os.path.islink(fs_path):
-        arch_path = '/'.join(pathbits)
-        link_value = os.readlink(fs_path)
-        fsum = md5_of_string(link_value)
-        item = Source(arch_path, TYPE_SYMLINK, fsum)
-        outbox[arch_path] = item
-        return fsum
-
-    is_dir = os.path.isdir(fs_path)
-    if not is_dir:
-        arch_path = '/'.join(pathbits)
-        fsum = md5_of_file(fs_path)
-        item = Source(arch_path, TYPE_FILE, fsum)
-        outbox[arch_path] = item
-        return fsum
 
+def list_dir_in_interest(fs_path, selector, state):
+    # Returns (entry, match state) pairs. Exclusions are checked on the name alone first,
+    # so an excluded entry is never stat'ed; is_dir() is answered from d_type and only costs
+    # a stat for symlinks.
     files = []
     dirs = []
-    for name in os.listdir(fs_path):
-        p = os.path.join(fs_path, name)
-        if os.path.isdir(p):
-            dirs.append(name)
-        else:
-            files.append(name)
-    dsum = hashlib.md5()
-    for name in sorted(files):
-        rel_path = make_rel_path(pathbits, name)
-        if not selector.file_in_interest(name, rel_path):
+    for entry in scandir(fs_path):
+        child_state = selector.step(state, entry.name) if state is not None else None
+        excludes = child_state.excludes if child_state is not None else 0
+        if excludes == EXCLUDE_ANY:
             continue
-        pathbits.append(name)
-        s = enum_fs_content_recursive(seed, selector, outbox, pathbits)
-        del pathbits[-1]
-        dsum.update(s.encode())
-    for name in sorted(dirs):
-        rel_path = make_rel_path(pathbits, name)
-        if not selector.dir_in_interest(name, rel_path):
+        if entry.is_dir():
+            if not excludes & EXCLUDE_DIR:
+                dirs.append((entry, child_state))
+        elif not excludes & EXCLUDE_FILE:
+            files.append((entry, child_state))
+    files.sort(key=lambda item: item[0].name)
+    dirs.sort(key=lambda item: item[0].name)
+    return files, dirs
+
+
+def make_leaf_source(entry, key, hasher, stat_cache):
+    if entry.is_symlink():
+        return Source(key, TYPE_SYMLINK, digest_of_string(os.readlink(entry.path)))
+    stat_key = stat_key_of(entry.stat())
+    fsum = stat_cache.lookup(key, stat_key)
+    if fsum is None:
+        fsum = hasher.file_digest(entry.path)
+    if not stat_cache.cacheable(stat_key):
+        stat_key = None
+    return Source(key, TYPE_FILE, fsum, stat_key)
+
+
+def enum_fs_content_iterative(top, key, state, selector, outbox, hasher, stat_cache, observer=None):
+    # Post-order walk with an explicit stack of [key, entries, digests] frames,
+    # a directory digest is taken once every entry of the directory is done.
+    # An observer is told about each directory before it is listed and gets its children in digest order.
+    if fs_type_of(top) != TYPE_DIR:
+        item = make_leaf_source(top, key, hasher, stat_cache)
+        outbox[key] = item
+        return item.digest
+
+    if observer is not None:
+        observer.dir_entered(key, top.path)
+    files, dirs = list_dir_in_interest(top.path, selector, state)
+    stack = [[key, files + dirs, []]]
+    while True:
+        frame_key, entries, digests = stack[-1]
+        if len(digests) < len(entries):
+            entry, child_state = entries[len(digests)]
+            child_key = make_child_key(frame_key, entry.name)
+            if entry.is_symlink() or not entry.is_dir():
+                item = make_leaf_source(entry, child_key, hasher, stat_cache)
+                outbox[child_key] = item
+                digests.append(item.digest)
+            else:
+                if observer is not None:
+                    observer.dir_entered(child_key, entry.path)
+                files, dirs = list_dir_in_interest(entry.path, selector, child_state)
+                stack.append([child_key, files + dirs, []])
             continue
-        pathbits.append(name)
-        s = enum_fs_content_recursive(seed, selector, outbox, pathbits)
-        del pathbits[-1]
-        dsum.update(s.encode())
+        stack.pop()
+        if observer is not None:
+            observer.dir_listed(frame_key, [make_child_key(frame_key, e.name) for e, _s in entries])
+        dir_digest = hasher.dir_digest(digests)
+        outbox[frame_key] = Source(frame_key, TYPE_DIR, dir_digest)
+        if not stack:
+            return dir_digest
+        stack[-1][2].append(dir_digest)
 
-    dir_digest = dsum.hexdigest()
-    if pathbits:
-        arch_path = '/'.join(pathbits)
-        item = Source(arch_path, TYPE_DIR, dir_digest)
-        outbox[arch_path] = item
-    else:
-        outbox[ROOT_KEY] = Source(ROOT_KEY, TYPE_DIR, dir_digest)
-    return dir_digest
+
+def time_ns():
+    if hasattr(time, 'time_ns'):
+        return time.time_ns()
+    return int(time.time() * 1000000000)
 
 
-def enum_fs_content(seed, selector):
-    pathbits = []
+def enum_fs_content(seed, selector, jobs=None, cached_nodes=None, observer=None):
     outbox = {}
-    enum_fs_content_recursive(seed, selector, outbox, pathbits)
+    hasher = make_hasher(jobs)
+    stat_cache = StatCache(cached_nodes, time_ns())
+    try:
+        enum_fs_content_iterative(PathEntry(seed), ROOT_KEY, selector.start(), selector, outbox, hasher, stat_cache, observer)
+        hasher.resolve(outbox)
+    except:
+        hasher.terminate()
+        raise
+    hasher.close()
     return outbox
 
 
@@ -255,7 +766,7 @@ def load_py_data(filename):
     return eval(ast, {'__builtins__': None}, {})
 
 
-def load_project(project_root, file_exclusions=None, dir_exclusions=None, fname_exclusions=None, dname_exclusions=None):
+def make_selector(file_exclusions=None, dir_exclusions=None, fname_exclusions=None, dname_exclusions=None):
     selector = FSSelector()
 
     if file_exclusions:
@@ -274,87 +785,339 @@ def load_project(project_root, file_exclusions=None, dir_exclusions=None, fname_
         for dname in dname_exclusions:
             selector.add_dir_name_to_exclusions(dname)
 
-    nodes = enum_fs_content(project_root, selector)
+    return selector
+
+
+def load_project(project_root, file_exclusions=None, dir_exclusions=None, fname_exclusions=None, dname_exclusions=None, jobs=None, cached_nodes=None):
+    selector = make_selector(file_exclusions=file_exclusions, dir_exclusions=dir_exclusions, fname_exclusions=fname_exclusions, dname_exclusions=dname_exclusions)
+    nodes = enum_fs_content(project_root, selector, jobs=jobs, cached_nodes=cached_nodes)
     return ProjectState(nodes)
 
 
+def replace_file(src, dst):
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+        return
+    if os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+
+def write_state_binary(filename, nodes, with_stats=True):
+    algorithm = _to_utf8(DIGEST_ALGORITHM)
+    digest_size = new_digest().digest_size
+    items = sorted(((_to_utf8(k), src) for k, src in nodes.items()), key=lambda item: item[0])
+    count = len(items)
+    has_stats = with_stats and any(src.stat is not None for _, src in items)
+    index_offset = _STATE_BINARY_HEADER.size + len(algorithm) + _STATE_BINARY_LAYOUT.size
+    entries_offset = index_offset + (count + 1) * _STATE_BINARY_OFFSET.size
+    stats_offset = entries_offset + count * (_STATE_BINARY_ENTRY.size + digest_size)
+    keys_offset = stats_offset
+    if has_stats:
+        keys_offset += count * _STATE_BINARY_STAT.size
+    else:
+        stats_offset = 0
+    with io.open(filename, mode='wb') as f:
+        f.write(_STATE_BINARY_HEADER.pack(STATE_BINARY_MAGIC, STATE_BINARY_VERSION, digest_size, len(algorithm)))
+        f.write(algorithm)
+        f.write(_STATE_BINARY_LAYOUT.pack(count, index_offset, entries_offset, stats_offset, keys_offset))
+        # every section is written record by record, the file buffer batches the small writes
+        position = 0
+        for key, _ in items:
+            f.write(_STATE_BINARY_OFFSET.pack(position))
+            position += len(key)
+        f.write(_STATE_BINARY_OFFSET.pack(position))
+        for _, src in items:
+            flags = STATE_RECORD_HAS_STAT if has_stats and src.stat is not None else 0
+            f.write(_STATE_BINARY_ENTRY.pack(_to_utf8(src.src_type), flags))
+            f.write(src._digest)
+        if has_stats:
+            for _, src in items:
+                f.write(_STATE_BINARY_STAT.pack(*(src.stat or (0, 0, 0))))
+        for key, _ in items:
+            f.write(key)
+
+
+def read_state_binary_header(f, state_file):
+    magic, version, digest_size, algorithm_size = _STATE_BINARY_HEADER.unpack(f.read(_STATE_BINARY_HEADER.size))
+    if version > STATE_BINARY_VERSION:
+        raise Exception("State file '{}' has unsupported format version {}.".format(state_file, version))
+    algorithm = f.read(algorithm_size).decode('utf-8')
+    return version, algorithm, digest_size
+
+
+def iter_state_binary_records(state_file):
+    # Version 1 layout: a stream of prefix-compressed records.
+    with io.open(state_file, mode='rb') as f:
+        _, _, digest_size = read_state_binary_header(f, state_file)
+        count, = _STATE_BINARY_COUNT.unpack(f.read(_STATE_BINARY_COUNT.size))
+        key = b''
+        for _ in range(count):
+            shared, suffix_size, type_code, flags = _STATE_BINARY_RECORD.unpack(f.read(_STATE_BINARY_RECORD.size))
+            tail = f.read(suffix_size + digest_size)
+            key = key[:shared] + tail[:suffix_size]
+            digest = binascii.hexlify(tail[suffix_size:]).decode('ascii')
+            stat_key = None
+            if flags & STATE_RECORD_HAS_STAT:
+                stat_key = _STATE_BINARY_STAT.unpack(f.read(_STATE_BINARY_STAT.size))
+            yield key.decode('utf-8'), type_code.decode('ascii'), digest, stat_key
+
+
+class MappedStateIndex:
+    # Version 2 layout: fixed-width key offsets, entries and stats, followed by the keys sorted bytewise.
+    def __init__(self, state_file):
+        self._file = io.open(state_file, mode='rb')
+        try:
+            _, _, self._digest_size = read_state_binary_header(self._file, state_file)
+            layout = _STATE_BINARY_LAYOUT.unpack(self._file.read(_STATE_BINARY_LAYOUT.size))
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except:
+            self._file.close()
+            raise
+        self._count, self._index_offset, self._entries_offset, self._stats_offset, self._keys_offset = layout
+        self._entry_size = _STATE_BINARY_ENTRY.size + self._digest_size
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, key):
+        return self._find(key) >= 0
+
+    def __getitem__(self, key):
+        src = self.get(key)
+        if src is None:
+            raise KeyError(key)
+        return src
+
+    def get(self, key, default=None):
+        i = self._find(key)
+        if i < 0:
+            return default
+        return self._source_at(i, key)
+
+    def keys(self):
+        for i in range(self._count):
+            yield self._key_at(i).decode('utf-8')
+
+    def values(self):
+        for i in range(self._count):
+            yield self._source_at(i)
+
+    def items(self):
+        for i in range(self._count):
+            src = self._source_at(i)
+            yield src.archive_path, src
+
+    def select_keys_of_children(self, parent_key):
+        ret = []
+        if parent_key == ROOT_KEY:
+            prefix = b''
+        else:
+            prefix = _to_utf8(parent_key) + b'/'
+        root_key = _to_utf8(ROOT_KEY)
+        i = self._lower_bound(prefix)
+        while i < self._count:
+            key = self._key_at(i)
+            if not key.startswith(prefix):
+                break
+            slash = key.find(b'/', len(prefix))
+            if slash < 0:
+                if key != root_key:
+                    ret.append(key.decode('utf-8'))
+                i += 1
+            else:
+                # skip the whole subtree of this child: '0' is the byte right after '/'
+                i = self._lower_bound(key[:slash] + b'0', i)
+        return ret
+
+    def _key_at(self, i):
+        start, end = _STATE_BINARY_KEY_SPAN.unpack_from(self._map, self._index_offset + i * _STATE_BINARY_OFFSET.size)
+        return self._map[self._keys_offset + start:self._keys_offset + end]
+
+    def _lower_bound(self, key, lo=0):
+        hi = self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _find(self, key):
+        key = _to_utf8(key)
+        i = self._lower_bound(key)
+        if i < self._count and self._key_at(i) == key:
+            return i
+        return -1
+
+    def _source_at(self, i, key=None):
+        offset = self._entries_offset + i * self._entry_size
+        type_code, flags = _STATE_BINARY_ENTRY.unpack_from(self._map, offset)
+        digest = binascii.hexlify(self._map[offset + _STATE_BINARY_ENTRY.size:offset + self._entry_size]).decode('ascii')
+        stat_key = None
+        if flags & STATE_RECORD_HAS_STAT:
+            stat_key = _STATE_BINARY_STAT.unpack_from(self._map, self._stats_offset + i * _STATE_BINARY_STAT.size)
+        if key is None:
+            key = self._key_at(i).decode('utf-8')
+        return Source(key, type_code.decode('ascii'), digest, stat_key)
+
+
+class MappedProjectState:
+    def __init__(self, state_file):
+        self.nodes = MappedStateIndex(state_file)
+
+    def close(self):
+        self.nodes.close()
+
+    def select_keys_of_children(self, parent_key):
+        return self.nodes.select_keys_of_children(parent_key)
+
+
+def is_binary_state_file(state_file):
+    with io.open(state_file, mode='rb') as f:
+        return f.read(len(STATE_BINARY_MAGIC)) == STATE_BINARY_MAGIC
+
+
+def read_state_digest_algorithm(state_file):
+    if is_binary_state_file(state_file):
+        with io.open(state_file, mode='rb') as f:
+            _, algorithm, _ = read_state_binary_header(f, state_file)
+        return algorithm
+    with io.open(state_file, mode='rt', encoding='utf8') as f:
+        header = f.readline().rstrip('\n')
+    if header.startswith(STATE_HEADER_DIGEST):
+        return header[len(STATE_HEADER_DIGEST):].strip()
+    return DEFAULT_DIGEST_ALGORITHM
+
+
 def load_project_from_state_file(state_file):
+    algorithm = read_state_digest_algorithm(state_file)
+    if algorithm != DIGEST_ALGORITHM:
+        raise Exception("State file '{}' holds '{}' digests, but '{}' is configured, re-create it with '--mode init'.".format(state_file, algorithm, DIGEST_ALGORITHM))
     nodes = {}
+    if is_binary_state_file(state_file):
+        with io.open(state_file, mode='rb') as f:
+            version, _, _ = read_state_binary_header(f, state_file)
+        if version >= 2:
+            return MappedProjectState(state_file)
+        for k, tpname, digest, stat_key in iter_state_binary_records(state_file):
+            nodes[k] = Source(k, tpname, digest, stat_key)
+        return ProjectState(nodes)
     flat = load_py_data(state_file)
     for k, v in flat.items():
         tpname, digest = v[0], v[1]
-        src = Source(k, tpname, digest)
+        stat_key = tuple(v[2:5]) if len(v) >= 5 else None
+        src = Source(k, tpname, digest, stat_key)
         nodes[k] = src
     return ProjectState(nodes)
 
 
-class ChangeNode:
-    def __init__(self, item_type, archive_path, flags):
+class ChangeNode(object):
+    __slots__ = ('item_type', 'archive_path', 'flags', 'old_digest', 'new_digest')
+
+    def __init__(self, item_type, archive_path, flags, old_digest=None, new_digest=None):
         self.item_type = item_type
         self.archive_path = archive_path
         self.flags = flags
+        self.old_digest = old_digest
+        self.new_digest = new_digest
+
+    def modification_type(self):
+        if self.flags & CHANGE_STATUS_ITEM_MODIFIED:
+            return 'M'
+        if self.flags & CHANGE_STATUS_ITEM_ADDED:
+            return 'A'
+        if self.flags & CHANGE_STATUS_ITEM_DELETED:
+            return 'D'
+        return '?'
+
+    def as_record(self):
+        return {
+            'type': self.item_type,
+            'path': self.archive_path,
+            'change': self.modification_type(),
+            'flags': self.flags,
+            'old_digest': self.old_digest,
+            'new_digest': self.new_digest,
+        }
 
     def __str__(self):
         seed_status = ' '
-        modification_type = '?'
-        if self.flags & CHANGE_STATUS_ITEM_MODIFIED:
-            modification_type = 'M'
-        elif self.flags & CHANGE_STATUS_ITEM_ADDED:
-            modification_type = 'A'
-            if self.flags & CHANGE_STATUS_SEEDING:
-                seed_status = '*'
-            elif self.flags & CHANGE_STATUS_INHERITED:
-                seed_status = '+'
-        elif self.flags & CHANGE_STATUS_ITEM_DELETED:
-            modification_type = 'D'
-            if self.flags & CHANGE_STATUS_SEEDING:
-                seed_status = '*'
-            elif self.flags & CHANGE_STATUS_INHERITED:
-                seed_status = '-'
+        modification_type = self.modification_type()
+        if self.flags & CHANGE_STATUS_SEEDING and not self.flags & CHANGE_STATUS_ITEM_MODIFIED:
+            seed_status = '*'
+        elif self.flags & CHANGE_STATUS_INHERITED:
+            seed_status = '+' if modification_type == 'A' else '-'
         return '{}   {},{}    {}'.format(seed_status, modification_type, self.item_type, self.archive_path)
 
 
 class ChangeSet:
+    # Records what happened at one key; subtrees of created or deleted directories are
+    # expanded only when iter_changes() is consumed, without recursion.
     def __init__(self, key):
         self.key = key
-        self.changes = []
-
-    def on_deleted(self, src, ctx, is_subcall):
-        flags = CHANGE_STATUS_ITEM_DELETED
-        item_recursive = is_item_type_recursive(src.src_type)
-        if not is_subcall and item_recursive:
-            flags |= CHANGE_STATUS_SEEDING
-        if is_subcall:
-            flags |= CHANGE_STATUS_INHERITED
-        node = ChangeNode(src.src_type, src.archive_path, flags)
-        self.changes.append(node)
-        if item_recursive:
-            children = ctx.select_keys_of_children(src.archive_path)
-            for child in sorted(children):
-                child_src = ctx.nodes[child]
-                self.on_deleted(child_src, ctx, True)
-
-    def on_created(self, src, ctx, is_subcall):
-        flags = CHANGE_STATUS_ITEM_ADDED
-        item_recursive = is_item_type_recursive(src.src_type)
-        if not is_subcall and item_recursive:
-            flags |= CHANGE_STATUS_SEEDING
-        if is_subcall:
-            flags |= CHANGE_STATUS_INHERITED
-        node = ChangeNode(src.src_type, src.archive_path, flags)
-        self.changes.append(node)
-        if item_recursive:
-            children = ctx.select_keys_of_children(src.archive_path)
-            for child in sorted(children):
-                child_src = ctx.nodes[child]
-                self.on_created(child_src, ctx, True)
+        self._events = []
+
+    def on_deleted(self, src, ctx):
+        self._events.append((CHANGE_STATUS_ITEM_DELETED, src, ctx))
+
+    def on_created(self, src, ctx):
+        self._events.append((CHANGE_STATUS_ITEM_ADDED, src, ctx))
 
     def on_modified(self, prev, now):
-        node = ChangeNode(now.src_type, now.archive_path, CHANGE_STATUS_ITEM_MODIFIED)
-        self.changes.append(node)
+        self._events.append((CHANGE_STATUS_ITEM_MODIFIED, prev, now))
+
+    def iter_changes(self):
+        for status, src, other in self._events:
+            if status == CHANGE_STATUS_ITEM_MODIFIED:
+                yield ChangeNode(other.src_type, other.archive_path, status, src.digest, other.digest)
+                continue
+            ctx = other
+            stack = [(src, False)]
+            while stack:
+                item, inherited = stack.pop()
+                item_recursive = is_item_type_recursive(item.src_type)
+                flags = status
+                if inherited:
+                    flags |= CHANGE_STATUS_INHERITED
+                elif item_recursive:
+                    flags |= CHANGE_STATUS_SEEDING
+                if status == CHANGE_STATUS_ITEM_DELETED:
+                    yield ChangeNode(item.src_type, item.archive_path, flags, old_digest=item.digest)
+                else:
+                    yield ChangeNode(item.src_type, item.archive_path, flags, new_digest=item.digest)
+                if item_recursive:
+                    for child in reversed(ctx.select_keys_of_children(item.archive_path)):
+                        stack.append((ctx.nodes[child], True))
+
+
+def merge_sorted_keys(a, b):
+    i, j = 0, 0
+    while i < len(a) and j < len(b):
+        if a[i] == b[j]:
+            yield a[i]
+            i += 1
+            j += 1
+        elif a[i] < b[j]:
+            yield a[i]
+            i += 1
+        else:
+            yield b[j]
+            j += 1
+    for k in a[i:]:
+        yield k
+    for k in b[j:]:
+        yield k
 
 
-def eval_diff_recursive(key, p, n, outbox):
+def eval_diff_item(key, p, n):
+    # Returns the change set at key, or the keys of children to compare when key is
+    # a directory whose digest moved; both are None when nothing changed.
     src_p = p.nodes.get(key)
     src_n = n.nodes.get(key)
 
@@ -363,54 +1126,604 @@ def eval_diff_recursive(key, p, n, outbox):
 
     if (src_p is None):
         changes = ChangeSet(key)
-        changes.on_created(src_n, n, False)
-        outbox[key] = changes
-        return
+        changes.on_created(src_n, n)
+        return changes, None
 
     if (src_n is None):
         changes = ChangeSet(key)
-        changes.on_deleted(src_p, p, False)
-        outbox[key] = changes
-        return
+        changes.on_deleted(src_p, p)
+        return changes, None
 
+    # raw digest bytes, the hex digest property would hexlify on every access
     prev_type = src_p.src_type
-    prev_digest = src_p.digest
+    prev_digest = src_p._digest
 
     now_type = src_n.src_type
-    now_digest = src_n.digest
+    now_digest = src_n._digest
 
     if (now_type != prev_type):
         changes = ChangeSet(key)
-        changes.on_deleted(src_p, False)
-        changes.on_created(src_n, False)
-        outbox[key] = changes
-        return
+        changes.on_deleted(src_p, p)
+        changes.on_created(src_n, n)
+        return changes, None
     else:
         node_type = now_type
 
     if (prev_digest == now_digest):
-        return
+        return None, None
 
     if not is_item_type_recursive(node_type):
         changes = ChangeSet(key)
         changes.on_modified(src_p, src_n)
-        outbox[key] = changes
-        return
+        return changes, None
+
+    return None, list(merge_sorted_keys(p.select_keys_of_children(key), n.select_keys_of_children(key)))
 
-    keys_of_children = p.select_keys_of_children(key) | n.select_keys_of_children(key)
 
-    for k in sorted(keys_of_children):
-        eval_diff_recursive(k, p, n, outbox)
+def collect_changes(changes):
+    for k in sorted(changes.keys()):
+        for node in changes[k].iter_changes():
+            yield node
 
 
 def eval_projects_diff(prev, now):
-    result = []
-    changes = {}
-    eval_diff_recursive(ROOT_KEY, prev, now, changes)
-    for k in sorted(changes.keys()):
-        chset = changes[k]
-        result += chset.changes
-    return result
+    # Generator of changes ordered by the key of their change set, as collect_changes does.
+    # The walk is depth first, which is not quite key order: 'a/x' is walked before 'a-c'
+    # but sorts after it. So a change set is held back only until no key still to be
+    # walked can sort before it.
+    held = []
+    stack = [[[ROOT_KEY], 0]]
+    while stack:
+        frame = stack[-1]
+        keys, pos = frame
+        if pos == len(keys):
+            stack.pop()
+        else:
+            frame[1] = pos + 1
+            key = keys[pos]
+            changes, children = eval_diff_item(key, prev, now)
+            if changes is not None:
+                heapq.heappush(held, (key, changes))
+            if children:
+                stack.append([children, 0])
+        if held:
+            bound = None
+            for keys, pos in stack:
+                if pos < len(keys) and (bound is None or keys[pos] < bound):
+                    bound = keys[pos]
+            while held and (bound is None or held[0][0] < bound):
+                for node in heapq.heappop(held)[1].iter_changes():
+                    yield node
+
+
+class SubtreeState:
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self._children = {}
+        for key in sorted(nodes.keys()):
+            parent_key = key.rpartition('/')[0] or ROOT_KEY
+            self._children.setdefault(parent_key, []).append(key)
+
+    def select_keys_of_children(self, parent_key):
+        return self._children.get(parent_key, [])
+
+
+def scan_created_subtree(entry, key, state, selector, hasher):
+    nodes = {}
+    enum_fs_content_iterative(entry, key, state, selector, nodes, hasher, StatCache(None, 0))
+    return SubtreeState(nodes)
+
+
+def eval_live_diff_entry(key, entry, state, selector, prev, hasher, stat_cache, created_hasher, found):
+    # Appends what changed at key to found as (key, change set, prev source, pending digest, created subtree),
+    # returns the children to walk, sorted by name, when key is a directory present on both sides.
+    src_p = prev.nodes.get(key)
+    if src_p is None:
+        ctx = scan_created_subtree(entry, key, state, selector, created_hasher)
+        changes = ChangeSet(key)
+        changes.on_created(ctx.nodes[key], ctx)
+        found.append((key, changes, None, None, ctx))
+        return None
+
+    now_type = fs_type_of(entry)
+    if now_type != src_p.src_type:
+        ctx = scan_created_subtree(entry, key, state, selector, created_hasher)
+        changes = ChangeSet(key)
+        changes.on_deleted(src_p, prev)
+        changes.on_created(ctx.nodes[key], ctx)
+        found.append((key, changes, None, None, ctx))
+        return None
+
+    if now_type == TYPE_SYMLINK:
+        digest = digest_of_string(os.readlink(entry.path))
+        found.append((key, None, src_p, digest, None))
+        return None
+
+    if now_type == TYPE_FILE:
+        digest = stat_cache.lookup(key, stat_key_of(entry.stat()))
+        if digest is None:
+            found.append((key, None, src_p, hasher.file_digest(entry.path), None))
+        elif digest != src_p.digest:
+            found.append((key, None, src_p, digest, None))
+        return None
+
+    files, dirs = list_dir_in_interest(entry.path, selector, state)
+    names_now = set(e.name for e, _s in files)
+    names_now.update(e.name for e, _s in dirs)
+    for child_key in prev.select_keys_of_children(key):
+        if child_key.rpartition('/')[2] not in names_now:
+            changes = ChangeSet(child_key)
+            changes.on_deleted(prev.nodes[child_key], prev)
+            found.append((child_key, changes, None, None, None))
+    children = sorted(files + dirs, key=lambda child: child[0].name)
+    return [(make_child_key(key, child.name), child, child_state) for child, child_state in children]
+
+
+def eval_live_diff_iterative(top, selector, prev, hasher, stat_cache, created_hasher):
+    # Generator of (found, bound) for every walked item: what changed there, and the smallest
+    # key still to be walked, None when nothing is left. Every directory is a frame of children
+    # sorted by key, so the bound is the smallest of the next keys of the frames.
+    stack = [[[(ROOT_KEY, top, selector.start())], 0]]
+    while stack:
+        frame = stack[-1]
+        entries, pos = frame
+        if pos == len(entries):
+            stack.pop()
+            continue
+        frame[1] = pos + 1
+        key, entry, state = entries[pos]
+        found = []
+        children = eval_live_diff_entry(key, entry, state, selector, prev, hasher, stat_cache, created_hasher, found)
+        if children:
+            stack.append([children, 0])
+        bound = None
+        for entries, pos in stack:
+            if pos < len(entries) and (bound is None or entries[pos][0] < bound):
+                bound = entries[pos][0]
+        yield found, bound
+
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_CLOEXEC = 0x00080000
+WATCH_EVENTS = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+WATCH_MASK = WATCH_EVENTS | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK
+_INOTIFY_EVENT = struct.Struct('iIII')
+INOTIFY_READ_SIZE = 64 * 1024
+
+
+def _fs_path_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return value.encode(sys.getfilesystemencoding() or 'utf-8', 'surrogateescape' if sys.version_info[0] >= 3 else 'strict')
+
+
+def _fs_path_str(value):
+    if sys.version_info[0] < 3:
+        return value
+    return value.decode(sys.getfilesystemencoding() or 'utf-8', 'surrogateescape')
+
+
+class Inotify:
+    # Thin ctypes binding, so watch mode needs nothing beyond the standard library on Linux.
+    def __init__(self):
+        try:
+            import ctypes
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            libc.inotify_init1
+        except (ImportError, OSError, AttributeError):
+            raise Exception("Watch mode requires inotify, which is only available on Linux.")
+        self._ctypes = ctypes
+        self._libc = libc
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            self._raise_errno('inotify_init1')
+
+    def _raise_errno(self, what):
+        err = self._ctypes.get_errno()
+        raise OSError(err, '{}: {}'.format(what, os.strerror(err)))
+
+    def add_watch(self, fs_path, mask):
+        wd = self._libc.inotify_add_watch(self.fd, _fs_path_bytes(fs_path), mask)
+        if wd < 0:
+            if self._ctypes.get_errno() == errno.ENOSPC:
+                raise Exception("Too many directories to watch under '{}', raise fs.inotify.max_user_watches.".format(fs_path))
+            self._raise_errno("inotify_add_watch '{}'".format(fs_path))
+        return wd
+
+    def rm_watch(self, wd):
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, timeout=None):
+        # Returns [(wd, mask, cookie, name)], empty when nothing arrived within timeout seconds.
+        ready, _w, _x = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        data = os.read(self.fd, INOTIFY_READ_SIZE)
+        events = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, name_len = _INOTIFY_EVENT.unpack_from(data, pos)
+            pos += _INOTIFY_EVENT.size
+            name = data[pos:pos + name_len].rstrip(b'\0')
+            pos += name_len
+            events.append((wd, mask, cookie, _fs_path_str(name) if name else None))
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class DirWatcher:
+    # Keeps one inotify watch per tracked directory, keyed both ways.
+    def __init__(self, inotify):
+        self.inotify = inotify
+        self._key_of_wd = {}
+        self._wd_of_key = {}
+
+    def __len__(self):
+        return len(self._wd_of_key)
+
+    def add(self, key, fs_path):
+        wd = self.inotify.add_watch(fs_path, WATCH_MASK)
+        # A directory moved inside the tree keeps its wd, which then belongs to the new key.
+        self._key_of_wd[wd] = key
+        self._wd_of_key[key] = wd
+
+    def remove(self, key):
+        wd = self._wd_of_key.pop(key, None)
+        if wd is not None and self._key_of_wd.get(wd) == key:
+            del self._key_of_wd[wd]
+            self.inotify.rm_watch(wd)
+
+    def forget(self, wd):
+        key = self._key_of_wd.pop(wd, None)
+        if key is not None and self._wd_of_key.get(key) == wd:
+            del self._wd_of_key[key]
+
+    def key_of(self, wd):
+        return self._key_of_wd.get(wd)
+
+    def keys(self):
+        return list(self._wd_of_key.keys())
+
+
+class WatchedProjectState:
+    # Tree kept current from inotify events: a change re-lists the directory it happened in,
+    # rescans only the entries that changed there, and re-derives digests of their ancestors.
+    def __init__(self, seed, selector, watcher=None):
+        self.seed = seed
+        self.selector = selector
+        self.watcher = watcher
+        self.nodes = {}
+        # children of each listed directory, in digest order and in key order
+        self._orders = {}
+        self._children = {}
+
+    def dir_entered(self, key, fs_path):
+        if self.watcher is not None:
+            self.watcher.add(key, fs_path)
+
+    def dir_listed(self, key, child_keys):
+        self._orders[key] = child_keys
+        self._children[key] = sorted(child_keys)
+
+    def select_keys_of_children(self, parent_key):
+        return self._children.get(parent_key, ())
+
+    def scan(self, jobs=None, cached_nodes=None):
+        self._orders = {}
+        self._children = {}
+        self.nodes = enum_fs_content(self.seed, self.selector, jobs=jobs, cached_nodes=cached_nodes, observer=self)
+        if self.watcher is not None:
+            for key in self.watcher.keys():
+                if key not in self._orders:
+                    self.watcher.remove(key)
+
+    def rescan(self, jobs=None):
+        # Used after the event queue overflowed: which events were lost is unknown, so every
+        # directory is re-listed, but only files whose size/mtime/inode moved are read again.
+        self.scan(jobs=jobs, cached_nodes=self.nodes)
+
+    def refresh(self, dirty):
+        # dirty maps a directory key to the names that had events in it.
+        touched = set()
+        for parent_key in sorted(dirty.keys()):
+            if parent_key not in self._orders:
+                continue
+            self._refresh_entries(parent_key, dirty[parent_key])
+            touched.add(parent_key)
+        self._update_dir_digests(touched)
+
+    def _state_of(self, key):
+        state = self.selector.start()
+        if key != ROOT_KEY:
+            for name in key.split('/'):
+                if state is None:
+                    break
+                state = self.selector.step(state, name)
+        return state
+
+    def _fs_path_of(self, key):
+        if key == ROOT_KEY:
+            return self.seed
+        return os.path.join(self.seed, *key.split('/'))
+
+    def _refresh_entries(self, parent_key, names):
+        files, dirs = list_dir_in_interest(self._fs_path_of(parent_key), self.selector, self._state_of(parent_key))
+        listed = {}
+        for entry, state in files + dirs:
+            listed[entry.name] = (entry, state)
+        for name in names:
+            key = make_child_key(parent_key, name)
+            old_nodes = self._drop_subtree(key)
+            if name not in listed:
+                continue
+            entry, state = listed[name]
+            outbox = {}
+            enum_fs_content_iterative(entry, key, state, self.selector, outbox, SerialHasher(), StatCache(old_nodes, time_ns()), self)
+            self.nodes.update(outbox)
+        self.dir_listed(parent_key, [make_child_key(parent_key, e.name) for e, _s in files + dirs])
+
+    def _drop_subtree(self, key):
+        dropped = {}
+        pending = [key]
+        while pending:
+            k = pending.pop()
+            src = self.nodes.pop(k, None)
+            if src is None:
+                continue
+            dropped[k] = src
+            self._children.pop(k, None)
+            children = self._orders.pop(k, None)
+            if children is not None:
+                pending.extend(children)
+                if self.watcher is not None:
+                    self.watcher.remove(k)
+        return dropped
+
+    def _update_dir_digests(self, touched):
+        dirs = set()
+        for key in touched:
+            while key not in dirs:
+                dirs.add(key)
+                if key == ROOT_KEY:
+                    break
+                key = key.rpartition('/')[0] or ROOT_KEY
+        for key in sorted(dirs, key=lambda k: -1 if k == ROOT_KEY else k.count('/'), reverse=True):
+            digest = digest_of_digests([self.nodes[c].digest for c in self._orders[key]])
+            self.nodes[key] = Source(key, TYPE_DIR, digest)
+
+
+# Modifications held back before the oldest one is waited for, hashes of later files go on meanwhile.
+LIVE_DIFF_WINDOW = 256
+
+
+def is_digest_ready(digest):
+    return not isinstance(digest, PendingDigest) or digest.ready()
+
+
+def live_change_of(item, hasher):
+    key, _seq, changes, src_p, digest, ctx = item
+    if ctx is not None:
+        hasher.resolve(ctx.nodes)
+        return changes
+    if changes is not None:
+        return changes
+    digest = resolve_digest(digest)
+    if digest == src_p.digest:
+        return None
+    changes = ChangeSet(key)
+    changes.on_modified(src_p, Source(key, src_p.src_type, digest))
+    return changes
+
+
+def eval_live_diff(seed, selector, prev, jobs=None, use_stat_cache=True, with_digests=False, cached_nodes=None):
+    # Generator of changes in the order of collect_changes, as eval_projects_diff is: a change is
+    # yielded once no key still to be walked can sort before it, and a modification once its
+    # digest is ready too, unless more than LIVE_DIFF_WINDOW changes are held.
+    # Content of created items is only read when with_digests asks for their new digests.
+    # File stats are looked up in prev unless cached_nodes come from elsewhere, e.g. the
+    # state file when prev is a snapshot.
+    hasher = make_hasher(jobs)
+    if cached_nodes is None:
+        cached_nodes = prev.nodes
+    stat_cache = StatCache(cached_nodes if use_stat_cache else None, time_ns())
+    held = []
+    seq = 0
+    try:
+        walk = eval_live_diff_iterative(PathEntry(seed), selector, prev, hasher, stat_cache, hasher if with_digests else NullHasher())
+        for found, bound in walk:
+            for item in found:
+                heapq.heappush(held, (item[0], seq) + item[1:])
+                seq += 1
+            while held and (bound is None or held[0][0] < bound):
+                if bound is not None and len(held) <= LIVE_DIFF_WINDOW and not is_digest_ready(held[0][4]):
+                    break
+                changes = live_change_of(heapq.heappop(held), hasher)
+                if changes is not None:
+                    for node in changes.iter_changes():
+                        yield node
+        while held:
+            changes = live_change_of(heapq.heappop(held), hasher)
+            if changes is not None:
+                for node in changes.iter_changes():
+                    yield node
+    except:
+        hasher.terminate()
+        raise
+    hasher.close()
+
+
+SNAPSHOT_INDEX_FILE = 'index.txt'
+SNAPSHOT_KIND_FULL = 'full'
+SNAPSHOT_KIND_DELTA = 'delta'
+SNAPSHOT_INDEX_FIELDS = ['name', 'kind', 'file', 'digest', 'entries', 'records', 'created']
+DEFAULT_SNAPSHOT_CHECKPOINT_INTERVAL = 8
+
+
+def eval_state_delta(prev, now):
+    # The ChangeNode-level changes plus a record for every directory whose digest moved
+    # on the way down to them, which is exactly what rebuilding 'now' from 'prev' takes.
+    stack = [ROOT_KEY]
+    while stack:
+        key = stack.pop()
+        changes, children = eval_diff_item(key, prev, now)
+        if changes is not None:
+            for node in changes.iter_changes():
+                yield node
+        if children is not None:
+            src = now.nodes[key]
+            yield ChangeNode(src.src_type, key, CHANGE_STATUS_ITEM_MODIFIED, prev.nodes[key].digest, src.digest)
+            stack.extend(reversed(children))
+
+
+def write_state_delta(filename, changes):
+    # Header as in binary state files, then a record count and
+    # (change, type, key size, key, digest unless deleted) records.
+    algorithm = _to_utf8(DIGEST_ALGORITHM)
+    digest_size = new_digest().digest_size
+    count = 0
+    with io.open(filename, mode='wb') as f:
+        f.write(_STATE_BINARY_HEADER.pack(STATE_DELTA_MAGIC, STATE_DELTA_VERSION, digest_size, len(algorithm)))
+        f.write(algorithm)
+        count_offset = f.tell()
+        f.write(_STATE_BINARY_COUNT.pack(0))
+        for node in changes:
+            key = _to_utf8(node.archive_path)
+            change = node.modification_type()
+            f.write(_STATE_DELTA_RECORD.pack(_to_utf8(change), _to_utf8(node.item_type), len(key)))
+            f.write(key)
+            if change != 'D':
+                f.write(binascii.unhexlify(node.new_digest))
+            count += 1
+        f.seek(count_offset)
+        f.write(_STATE_BINARY_COUNT.pack(count))
+    return count
+
+
+def apply_state_delta(nodes, delta_file):
+    with io.open(delta_file, mode='rb') as f:
+        magic = f.read(len(STATE_DELTA_MAGIC))
+        if magic != STATE_DELTA_MAGIC:
+            raise Exception("File '{}' is not a state delta.".format(delta_file))
+        f.seek(0)
+        _, _, digest_size = read_state_binary_header(f, delta_file)
+        count, = _STATE_BINARY_COUNT.unpack(f.read(_STATE_BINARY_COUNT.size))
+        for _ in range(count):
+            change, type_code, key_size = _STATE_DELTA_RECORD.unpack(f.read(_STATE_DELTA_RECORD.size))
+            key = f.read(key_size).decode('utf-8')
+            if change == b'D':
+                nodes.pop(key, None)
+            else:
+                digest = binascii.hexlify(f.read(digest_size)).decode('ascii')
+                nodes[key] = Source(key, type_code.decode('ascii'), digest)
+
+
+class SnapshotStore:
+    # Named snapshots of a state kept in one directory. Every checkpoint_interval-th snapshot,
+    # and any whose delta would not be much smaller than the tree, is a full binary state;
+    # the rest are deltas against the snapshot before them, so the store grows with churn.
+    def __init__(self, root, checkpoint_interval=DEFAULT_SNAPSHOT_CHECKPOINT_INTERVAL):
+        self.root = root
+        self.checkpoint_interval = checkpoint_interval
+        index_file = os.path.join(root, SNAPSHOT_INDEX_FILE)
+        self.entries = load_py_data(index_file) if os.path.isfile(index_file) else []
+
+    def names(self):
+        return [entry['name'] for entry in self.entries]
+
+    def _position(self, name):
+        for i, entry in enumerate(self.entries):
+            if entry['name'] == name:
+                return i
+        raise Exception("Snapshot '{}' not found in '{}'.".format(name, self.root))
+
+    def load_nodes(self, name):
+        end = self._position(name)
+        if self.entries[end]['digest'] != DIGEST_ALGORITHM:
+            raise Exception("Snapshot '{}' holds '{}' digests, but '{}' is configured.".format(name, self.entries[end]['digest'], DIGEST_ALGORITHM))
+        start = end
+        while self.entries[start]['kind'] != SNAPSHOT_KIND_FULL:
+            start -= 1
+        checkpoint = load_project_from_state_file(os.path.join(self.root, self.entries[start]['file']))
+        try:
+            nodes = {}
+            for key, src in checkpoint.nodes.items():
+                nodes[key] = src
+        finally:
+            checkpoint.close()
+        for entry in self.entries[start + 1:end + 1]:
+            apply_state_delta(nodes, os.path.join(self.root, entry['file']))
+        return nodes
+
+    def load(self, name):
+        return ProjectState(self.load_nodes(name))
+
+    def diff(self, name_from, name_to):
+        return eval_projects_diff(self.load(name_from), self.load(name_to))
+
+    def add(self, name, project):
+        if name in self.names():
+            raise Exception("Snapshot '{}' already exists in '{}'.".format(name, self.root))
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        since_checkpoint = 0
+        for entry in reversed(self.entries):
+            if entry['kind'] == SNAPSHOT_KIND_FULL:
+                break
+            since_checkpoint += 1
+        number = len(self.entries) + 1
+        kind = SNAPSHOT_KIND_FULL
+        records = len(project.nodes)
+        if self.entries and self.entries[-1]['digest'] == DIGEST_ALGORITHM and since_checkpoint + 1 < self.checkpoint_interval:
+            filename = os.path.join(self.root, '{:06d}.{}'.format(number, SNAPSHOT_KIND_DELTA))
+            count = write_state_delta(filename + '.tmp', eval_state_delta(self.load(self.entries[-1]['name']), project))
+            if count * 2 <= len(project.nodes):
+                replace_file(filename + '.tmp', filename)
+                kind = SNAPSHOT_KIND_DELTA
+                records = count
+            else:
+                os.remove(filename + '.tmp')
+        if kind == SNAPSHOT_KIND_FULL:
+            filename = os.path.join(self.root, '{:06d}.{}'.format(number, SNAPSHOT_KIND_FULL))
+            write_state_binary(filename + '.tmp', project.nodes, with_stats=False)
+            replace_file(filename + '.tmp', filename)
+        self.entries.append({
+            'name': name,
+            'kind': kind,
+            'file': os.path.basename(filename),
+            'digest': DIGEST_ALGORITHM,
+            'entries': len(project.nodes),
+            'records': records,
+            'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        })
+        self._write_index()
+        return self.entries[-1]
+
+    def _write_index(self):
+        index_file = os.path.join(self.root, SNAPSHOT_INDEX_FILE)
+        with io.open(index_file + '.tmp', mode='wt', encoding='utf8') as f:
+            f.write(_to_string('[\n'))
+            for entry in self.entries:
+                fields = ', '.join('{!r}: {!r}'.format(_to_string(k), entry[k]) for k in SNAPSHOT_INDEX_FIELDS)
+                f.write(_to_string('    {' + fields + '},\n'))
+            f.write(_to_string(']\n'))
+        replace_file(index_file + '.tmp', index_file)
 
 
 # ============================================================================================================================
@@ -473,7 +1786,10 @@ DIR_HOME = None
 TAG_CONFIG = 'CONFIG'
 TAG_DIR_TRACK_ROOT = 'DIR_TRACK_ROOT'
 TAG_DIR_CACHE = 'DIR_CACHE'
+TAG_DIGEST = 'DIGEST'
+TAG_STATE_FORMAT = 'STATE_FORMAT'
 TAG_STATE_FILE = 'STATE_FILE'
+TAG_SNAPSHOT_CHECKPOINT_INTERVAL = 'SNAPSHOT_CHECKPOINT_INTERVAL'
 TAG_DIRS_EXCLUDE_BY_FULL_PATH = 'DIRS_EXCLUDE_BY_FULL_PATH'
 TAG_FILES_EXCLUDE_BY_FULL_PATH = 'FILES_EXCLUDE_BY_FULL_PATH'
 TAG_DIRS_EXCLUDE_BY_NAME = 'DIRS_EXCLUDE_BY_NAME'
@@ -488,16 +1804,35 @@ def load_config(conf_file):
     config.read(conf_path)
     global DIR_HOME
     DIR_HOME = os.path.dirname(conf_path)
+    set_digest_algorithm(get_conf_string0(config, TAG_CONFIG, TAG_DIGEST) or DEFAULT_DIGEST_ALGORITHM)
+    set_state_format(get_conf_string0(config, TAG_CONFIG, TAG_STATE_FORMAT) or STATE_FORMAT_BINARY)
     return config
 
 
-def scan_project(scan_root, output, file_exclusions=None, dir_exclusions=None, fname_exclusions=None, dname_exclusions=None):
+def scan_project(scan_root, output, file_exclusions=None, dir_exclusions=None, fname_exclusions=None, dname_exclusions=None, jobs=None, cached_project=None):
     print("> SCAN: {} -> {}".format(scan_root, output))
-    project = load_project(scan_root, file_exclusions=file_exclusions, dir_exclusions=dir_exclusions, fname_exclusions=fname_exclusions, dname_exclusions=dname_exclusions)
+    cached_nodes = cached_project.nodes if cached_project is not None else None
+    project = load_project(scan_root, file_exclusions=file_exclusions, dir_exclusions=dir_exclusions, fname_exclusions=fname_exclusions, dname_exclusions=dname_exclusions,
+        jobs=jobs, cached_nodes=cached_nodes)
+    if cached_project is not None:
+        cached_project.close()
     project.write(output)
+    return project
+
+
+def open_snapshot_store(config, state_file):
+    interval = get_conf_string0(config, TAG_CONFIG, TAG_SNAPSHOT_CHECKPOINT_INTERVAL)
+    return SnapshotStore(state_file + '.snapshots', int(interval) if interval else DEFAULT_SNAPSHOT_CHECKPOINT_INTERVAL)
 
 
-def gen_state(config):
+def load_baseline(config, state_file, name):
+    # The project to diff against: the state file, or the named snapshot when one is given.
+    if name is None:
+        return load_project_from_state_file(state_file)
+    return open_snapshot_store(config, state_file).load(name)
+
+
+def gen_state(config, args):
     cache_dir = get_os_path_from_config(config, TAG_CONFIG, TAG_DIR_CACHE, DIR_HOME)
     dir_to_track = get_os_path_from_config(config, TAG_CONFIG, TAG_DIR_TRACK_ROOT, DIR_HOME)
     state_file = os.path.join(cache_dir, get_conf_string1(config, TAG_CONFIG, TAG_STATE_FILE))
@@ -506,23 +1841,149 @@ def gen_state(config):
     dname_exclusions = get_conf_strings_optional(config, TAG_CONFIG, TAG_DIRS_EXCLUDE_BY_NAME)
     fname_exclusions = get_conf_strings_optional(config, TAG_CONFIG, TAG_FILES_EXCLUDE_BY_NAME)
 
-    scan_project(dir_to_track, state_file,
+    store = None
+    if args.snapshot:
+        store = open_snapshot_store(config, state_file)
+        if args.snapshot in store.names():
+            raise Exception("Snapshot '{}' already exists in '{}'.".format(args.snapshot, store.root))
+
+    cached_project = None
+    if not args.rehash and os.path.isfile(state_file) and read_state_digest_algorithm(state_file) == DIGEST_ALGORITHM:
+        cached_project = load_project_from_state_file(state_file)
+
+    project = scan_project(dir_to_track, state_file,
         dir_exclusions=dir_exclusions, file_exclusions=file_exclusions,
-        dname_exclusions=dname_exclusions, fname_exclusions=fname_exclusions)
+        dname_exclusions=dname_exclusions, fname_exclusions=fname_exclusions, jobs=args.jobs, cached_project=cached_project)
+    if store is not None:
+        entry = store.add(args.snapshot, project)
+        print("> SNAPSHOT: '{}' stored as {} with {} records".format(entry['name'], entry['kind'], entry['records']))
 
 
-def report_projects_diff(project_old, project_new):
-    print("> Analyzing changes ...")
+def report_projects_diff(project_old, project_new, output=OUTPUT_TEXT):
+    if output == OUTPUT_TEXT:
+        print("> Analyzing changes ...")
     changes = eval_projects_diff(project_old, project_new)
-    if not changes:
-        print("No changes.")
-    else:
-        print("Changes are the following:")
+    report_changes(changes, output)
+
+
+def report_changes(changes, output=OUTPUT_TEXT):
+    # Changes may be a generator: each one is written as soon as it is produced.
+    if output == OUTPUT_JSONL:
         for node in changes:
-            print(node)
+            sys.stdout.write(json.dumps(node.as_record(), sort_keys=True) + '\n')
+        return
+    reported = False
+    for node in changes:
+        if not reported:
+            print("Changes are the following:")
+            reported = True
+        print(node)
+    if not reported:
+        print("No changes.")
 
 
-def report_diff(config):
+def report_diff(config, args):
+    cache_dir = get_os_path_from_config(config, TAG_CONFIG, TAG_DIR_CACHE, DIR_HOME)
+    dir_to_track = get_os_path_from_config(config, TAG_CONFIG, TAG_DIR_TRACK_ROOT, DIR_HOME)
+    state_file = os.path.join(cache_dir, get_conf_string1(config, TAG_CONFIG, TAG_STATE_FILE))
+    dir_exclusions = get_conf_strings_optional(config, TAG_CONFIG, TAG_DIRS_EXCLUDE_BY_FULL_PATH)
+    file_exclusions = get_conf_strings_optional(config, TAG_CONFIG, TAG_FILES_EXCLUDE_BY_FULL_PATH)
+    dname_exclusions = get_conf_strings_optional(config, TAG_CONFIG, TAG_DIRS_EXCLUDE_BY_NAME)
+    fname_exclusions = get_conf_strings_optional(config, TAG_CONFIG, TAG_FILES_EXCLUDE_BY_NAME)
+
+    # With JSON Lines on stdout, progress goes to stderr.
+    log = sys.stdout if args.output == OUTPUT_TEXT else sys.stderr
+    log.write("> SCAN: {}\n".format(state_file if args.from_snapshot is None else "snapshot '{}'".format(args.from_snapshot)))
+    project_from = load_baseline(config, state_file, args.from_snapshot)
+    cached_project = None
+    try:
+        if args.from_snapshot is not None and os.path.isfile(state_file) and read_state_digest_algorithm(state_file) == DIGEST_ALGORITHM:
+            cached_project = load_project_from_state_file(state_file)
+        log.write("> SCAN: {}\n".format(dir_to_track))
+        selector = make_selector(file_exclusions=file_exclusions, dir_exclusions=dir_exclusions, fname_exclusions=fname_exclusions, dname_exclusions=dname_exclusions)
+        log.write("> Analyzing changes ...\n")
+        changes = eval_live_diff(dir_to_track, selector, project_from, jobs=args.jobs, use_stat_cache=not args.rehash,
+            with_digests=args.output == OUTPUT_JSONL, cached_nodes=cached_project.nodes if cached_project is not None else None)
+        report_changes(changes, args.output)
+    finally:
+        if cached_project is not None:
+            cached_project.close()
+        project_from.close()
+
+
+def report_snapshots_diff(config, args):
+    cache_dir = get_os_path_from_config(config, TAG_CONFIG, TAG_DIR_CACHE, DIR_HOME)
+    state_file = os.path.join(cache_dir, get_conf_string1(config, TAG_CONFIG, TAG_STATE_FILE))
+    if args.from_snapshot is None:
+        raise Exception("Option '--from-snapshot' is required by '--mode {}'.".format(args.mode))
+    log = sys.stdout if args.output == OUTPUT_TEXT else sys.stderr
+    log.write("> SNAPSHOT: {} -> {}\n".format(args.from_snapshot, args.to_snapshot or state_file))
+    project_from = load_baseline(config, state_file, args.from_snapshot)
+    try:
+        project_to = load_baseline(config, state_file, args.to_snapshot)
+        try:
+            report_changes(eval_projects_diff(project_from, project_to), args.output)
+        finally:
+            project_to.close()
+    finally:
+        project_from.close()
+
+
+def list_snapshots(config, args):
+    cache_dir = get_os_path_from_config(config, TAG_CONFIG, TAG_DIR_CACHE, DIR_HOME)
+    state_file = os.path.join(cache_dir, get_conf_string1(config, TAG_CONFIG, TAG_STATE_FILE))
+    store = open_snapshot_store(config, state_file)
+    if not store.entries:
+        print("No snapshots in '{}'.".format(store.root))
+        return
+    for entry in store.entries:
+        size = os.path.getsize(os.path.join(store.root, entry['file']))
+        print("    {:<24} {:<19} {:<5} {:>9} entries {:>9} records {:>11} bytes  {}".format(
+            entry['name'], entry['created'], entry['kind'], entry['entries'], entry['records'], size, entry['digest']))
+
+
+WATCH_SETTLE_SECONDS = 0.05
+WATCH_MAX_BATCH_SECONDS = 1.0
+
+
+def collect_watch_events(inotify, watcher):
+    # Blocks for the first event, then keeps reading until the tree is quiet for a moment,
+    # so a burst such as a checkout is applied as one batch.
+    dirty = {}
+    overflow = False
+    root_gone = False
+    count = 0
+    started = None
+    timeout = None
+    while True:
+        events = inotify.read_events(timeout)
+        if not events:
+            break
+        if started is None:
+            started = time.time()
+            timeout = WATCH_SETTLE_SECONDS
+        for wd, mask, _cookie, name in events:
+            count += 1
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            if mask & IN_IGNORED:
+                watcher.forget(wd)
+                continue
+            key = watcher.key_of(wd)
+            if key is None:
+                continue
+            if name is None:
+                if key == ROOT_KEY and mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    root_gone = True
+                continue
+            dirty.setdefault(key, set()).add(name)
+        if time.time() - started > WATCH_MAX_BATCH_SECONDS:
+            break
+    return dirty, overflow, root_gone, count
+
+
+def watch_changes(config, args):
     cache_dir = get_os_path_from_config(config, TAG_CONFIG, TAG_DIR_CACHE, DIR_HOME)
     dir_to_track = get_os_path_from_config(config, TAG_CONFIG, TAG_DIR_TRACK_ROOT, DIR_HOME)
     state_file = os.path.join(cache_dir, get_conf_string1(config, TAG_CONFIG, TAG_STATE_FILE))
@@ -533,9 +1994,85 @@ def report_diff(config):
 
     print("> SCAN: {}".format(state_file))
     project_from = load_project_from_state_file(state_file)
-    print("> SCAN: {}".format(dir_to_track))
-    project_to = load_project(dir_to_track, file_exclusions=file_exclusions, dir_exclusions=dir_exclusions, fname_exclusions=fname_exclusions, dname_exclusions=dname_exclusions)
-    report_projects_diff(project_from, project_to)
+    selector = make_selector(file_exclusions=file_exclusions, dir_exclusions=dir_exclusions, fname_exclusions=fname_exclusions, dname_exclusions=dname_exclusions)
+    inotify = Inotify()
+    try:
+        watcher = DirWatcher(inotify)
+        project_now = WatchedProjectState(dir_to_track, selector, watcher)
+        print("> SCAN: {}".format(dir_to_track))
+        project_now.scan(jobs=args.jobs, cached_nodes=None if args.rehash else project_from.nodes)
+        print("> Watching {} directories, press Ctrl+C to stop.".format(len(watcher)))
+        reported = [str(c) for c in eval_projects_diff(project_from, project_now)]
+        report_changes(reported)
+        while True:
+            dirty, overflow, root_gone, count = collect_watch_events(inotify, watcher)
+            if root_gone:
+                raise Exception("Tracked directory '{}' was removed or moved.".format(dir_to_track))
+            started = time.time()
+            if overflow:
+                print("> Event queue overflowed, rescanning '{}' ...".format(dir_to_track))
+                project_now.rescan(jobs=args.jobs)
+            else:
+                project_now.refresh(dirty)
+            changes = [str(c) for c in eval_projects_diff(project_from, project_now)]
+            elapsed_ms = (time.time() - started) * 1000
+            if changes != reported:
+                print("> {}: {} events in {} directories, updated in {:.1f} ms".format(time.strftime('%H:%M:%S'), count, len(dirty), elapsed_ms))
+                report_changes(changes)
+                reported = changes
+    except KeyboardInterrupt:
+        pass
+    finally:
+        project_from.close()
+        inotify.close()
+
+
+BENCHMARK_DIGEST_CANDIDATES = ['md5', 'sha1', 'sha256', 'sha512', 'blake2b', 'blake2s', 'sha3_256'] + list(XXHASH_ALGORITHMS)
+BENCHMARK_FILES_PER_DIR = 64
+BENCHMARK_FILE_SIZES = [4 * 1024, 64 * 1024, 512 * 1024, 4 * 1024 * 1024]
+
+
+def make_synthetic_tree(root, total_bytes):
+    block = os.urandom(max(BENCHMARK_FILE_SIZES))
+    written = 0
+    index = 0
+    while written < total_bytes:
+        dir_path = os.path.join(root, 'd{:04d}'.format(index // BENCHMARK_FILES_PER_DIR))
+        if not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+        size = BENCHMARK_FILE_SIZES[index % len(BENCHMARK_FILE_SIZES)]
+        with io.open(os.path.join(dir_path, 'f{:06d}'.format(index)), mode='wb') as f:
+            f.write(block[:size])
+        written += size
+        index += 1
+    return written, index
+
+
+def benchmark_digests(config, args):
+    configured = DIGEST_ALGORITHM
+    root = tempfile.mkdtemp(prefix='diff-tracker-bench-')
+    try:
+        total_bytes, total_files = make_synthetic_tree(root, args.bench_size_mb * 1024 * 1024)
+        print("> Synthetic tree: {} files, {} MB in '{}'".format(total_files, total_bytes // (1024 * 1024), root))
+        selector = FSSelector()
+        enum_fs_content(root, selector)
+        results = []
+        for name in BENCHMARK_DIGEST_CANDIDATES:
+            try:
+                set_digest_algorithm(name)
+            except Exception as ex:
+                print("    {:<10} skipped, {}".format(name, ex))
+                continue
+            started = time.time()
+            enum_fs_content(root, selector, jobs=args.jobs)
+            elapsed = max(time.time() - started, 1e-6)
+            results.append((total_bytes / elapsed / (1024 * 1024), elapsed, name))
+        print("> Throughput with --jobs {} (page cache warm):".format(args.jobs))
+        for mbps, elapsed, name in sorted(results, reverse=True):
+            print("    {:<10} {:10.1f} MB/s {:8.2f} s".format(name, mbps, elapsed))
+    finally:
+        shutil.rmtree(root)
+        set_digest_algorithm(configured)
 
 
 # ============================================================================================================================
@@ -545,16 +2082,28 @@ def report_diff(config):
 
 TAG_RUN_MODE_INIT = 'init'
 TAG_RUN_MODE_DIFF = 'diff'
+TAG_RUN_MODE_WATCH = 'watch'
+TAG_RUN_MODE_DIFF_SNAPSHOTS = 'diff-snapshots'
+TAG_RUN_MODE_LIST_SNAPSHOTS = 'list-snapshots'
+TAG_RUN_MODE_BENCHMARK_DIGEST = 'benchmark-digest'
 
 
 RUN_MODES = [
   TAG_RUN_MODE_INIT,
   TAG_RUN_MODE_DIFF,
+  TAG_RUN_MODE_WATCH,
+  TAG_RUN_MODE_DIFF_SNAPSHOTS,
+  TAG_RUN_MODE_LIST_SNAPSHOTS,
+  TAG_RUN_MODE_BENCHMARK_DIGEST,
 ]
 
 RUN_MAPPING = {
   TAG_RUN_MODE_INIT: gen_state,
   TAG_RUN_MODE_DIFF: report_diff,
+  TAG_RUN_MODE_WATCH: watch_changes,
+  TAG_RUN_MODE_DIFF_SNAPSHOTS: report_snapshots_diff,
+  TAG_RUN_MODE_LIST_SNAPSHOTS: list_snapshots,
+  TAG_RUN_MODE_BENCHMARK_DIGEST: benchmark_digests,
 }
 
 
@@ -562,7 +2111,14 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--config', required=True)
     parser.add_argument('--mode', required=True, choices=RUN_MODES)
+    parser.add_argument('--jobs', type=int, default=1, help='number of worker threads used to hash file content')
+    parser.add_argument('--rehash', action='store_true', help='ignore size/mtime/inode recorded in the state file and hash every file')
+    parser.add_argument('--bench-size-mb', type=int, default=256, help='size of the synthetic tree used by benchmark-digest')
+    parser.add_argument('--output', choices=OUTPUTS, default=OUTPUT_TEXT, help='format of the diff report, jsonl writes one JSON record per change')
+    parser.add_argument('--snapshot', help='with init, also keep the new state as a named snapshot')
+    parser.add_argument('--from-snapshot', help='diff against this snapshot instead of the state file')
+    parser.add_argument('--to-snapshot', help='with diff-snapshots, the snapshot to compare to, the state file by default')
     args = parser.parse_args()
     config = load_config(args.config)
     run_func = RUN_MAPPING[args.mode]
-    run_func(config)
+    run_func(config, args)
@@ -3,13 +3,23 @@ import os.path
 import shutil
 
 def dir_del(dir_base, subject):
-    if os.path.exists(subject):
-        shutil.rmtree(subject)
+    target = os.path.normpath(os.path.join(dir_base, subject))
+    if os.path.isdir(target):
+        shutil.rmtree(target)
+    elif os.path.exists(target):
+        os.remove(target)
 
 
-if __name__ == '__main__':
+def make_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('--target', required=True)
     parser.add_argument('--subject', required=True)
-    args = parser.parse_args()
+    return parser
+
+
+def main(args, context):
     dir_del(args.target, args.subject)
+
+
+if __name__ == '__main__':
+    main(make_parser().parse_args(), {})
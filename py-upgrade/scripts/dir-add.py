@@ -3,19 +3,42 @@ import os.path
 import shutil
 import subprocess
 
+from placement import LINK_AUTO, LINK_MODES, file_placer_of
 
-def dir_add(dir_from, dir_to, dir_subject):
+
+def dir_add(dir_from, dir_to, dir_subject, placer=None):
     source = os.path.normpath(os.path.join(dir_from, dir_subject))
     target = os.path.normpath(os.path.join(dir_to, dir_subject))
     if os.path.exists(target):
         shutil.rmtree(target)
-    shutil.copytree(source, target)
+    if placer is None:
+        shutil.copytree(source, target)
+        return
+    # same layout as copytree, but every file goes through the placer
+    created_dirs = []
+    for dir_path, dir_names, file_names in os.walk(source, followlinks=True):
+        rel_dir = os.path.relpath(dir_path, dir_from)
+        target_dir = os.path.join(dir_to, rel_dir)
+        os.makedirs(target_dir)
+        created_dirs.append((dir_path, target_dir))
+        for name in file_names:
+            placer.place(os.path.join(dir_path, name), os.path.join(target_dir, name))
+    for dir_path, target_dir in reversed(created_dirs):
+        shutil.copystat(dir_path, target_dir)
 
 
-if __name__ == '__main__':
+def make_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('--source', required=True)
     parser.add_argument('--target', required=True)
     parser.add_argument('--subject', required=True)
-    args = parser.parse_args()
-    dir_add(args.source, args.target, args.subject)
+    parser.add_argument('--link', default=LINK_AUTO, choices=LINK_MODES)
+    return parser
+
+
+def main(args, context):
+    dir_add(args.source, args.target, args.subject, placer=file_placer_of(context, args.link))
+
+
+if __name__ == '__main__':
+    main(make_parser().parse_args(), {})
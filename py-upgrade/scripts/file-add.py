@@ -4,19 +4,32 @@ import os
 import shutil
 import subprocess
 
+from placement import LINK_AUTO, LINK_MODES, file_placer_of
 
-def file_add(dir_from, dir_to, file_subject):
+
+def file_add(dir_from, dir_to, file_subject, placer=None):
     source = os.path.normpath(os.path.join(dir_from, file_subject))
     target = os.path.normpath(os.path.join(dir_to, file_subject))
+    if placer is not None:
+        placer.place(source, target)
+        return
     if os.path.exists(target):
         os.remove(target)
     shutil.copy2(source, target)
 
 
-if __name__ == '__main__':
+def make_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('--source', required=True)
     parser.add_argument('--target', required=True)
     parser.add_argument('--subject', required=True)
-    args = parser.parse_args()
-    file_add(args.source, args.target, args.subject)
+    parser.add_argument('--link', default=LINK_AUTO, choices=LINK_MODES)
+    return parser
+
+
+def main(args, context):
+    file_add(args.source, args.target, args.subject, placer=file_placer_of(context, args.link))
+
+
+if __name__ == '__main__':
+    main(make_parser().parse_args(), {})
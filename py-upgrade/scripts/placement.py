@@ -0,0 +1,67 @@
+import os.path
+import os
+import shutil
+
+LINK_AUTO = 'auto'
+LINK_REFLINK = 'reflink'
+LINK_COPY = 'copy'
+LINK_MODES = [LINK_AUTO, LINK_REFLINK, LINK_COPY]
+
+# _IOW(0x94, 9, int): clones a whole file on copy-on-write filesystems (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+
+def clone_file(source, target):
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    cloned = True
+    with open(source, 'rb') as src:
+        with open(target, 'wb') as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            except (IOError, OSError):
+                cloned = False
+    if not cloned:
+        os.remove(target)
+    return cloned
+
+
+class FilePlacer(object):
+    # Places vendor files into the repo as reflink clones, which share the source extents
+    # copy-on-write and cost neither a read nor a write of the content, or as plain copies.
+    # Repo files may be edited in place later, so they are never hardlinked to the source.
+    def __init__(self, link_mode=LINK_AUTO):
+        if link_mode not in LINK_MODES:
+            raise Exception("Unknown link mode '{}', expected one of: {}.".format(link_mode, ', '.join(LINK_MODES)))
+        self.link_mode = link_mode
+        self._try_clone = (link_mode != LINK_COPY)
+
+    def place(self, source, target):
+        # Returns True when the target is a clone of the source.
+        if os.path.exists(target):
+            os.remove(target)
+        if self._try_clone:
+            if clone_file(source, target):
+                shutil.copystat(source, target)
+                return True
+            if self.link_mode == LINK_REFLINK:
+                raise Exception("Failed to reflink '{}' to '{}', the filesystem doesn't support it.".format(source, target))
+            # source and target don't share a copy-on-write filesystem, skip the attempt from now on
+            self._try_clone = False
+        shutil.copy2(source, target)
+        return False
+
+
+# A run context is a plain dict owned by the caller: a script run from the command line
+# gets a fresh one, while upgrade.py keeps one for all the items it applies in-process,
+# so a failed clone attempt is not repeated for every item of the run.
+
+def file_placer_of(context, link_mode):
+    key = ('placer', link_mode)
+    placer = context.get(key)
+    if placer is None:
+        placer = FilePlacer(link_mode)
+        context[key] = placer
+    return placer
@@ -1,12 +1,234 @@
 from __future__ import print_function
 import argparse
+import multiprocessing
 import os.path
 import os
-import shutil
-import subprocess
+import sys
 
-DIFF_TOOL = r'C:\Git\usr\bin\diff.exe'
-PATCH_TOOL = r'C:\Git\usr\bin\patch.exe'
+MARKER_REPO = b'<<<<<<< repo'
+MARKER_BASE = b'||||||| vendor-from'
+MARKER_SEPARATOR = b'======='
+MARKER_VENDOR = b'>>>>>>> vendor-to'
+
+
+def read_lines(path):
+    with open(path, 'rb') as f:
+        return f.read().splitlines(True)
+
+
+def line_key(line):
+    # lines compare like 'diff --strip-trailing-cr' does
+    if line.endswith(b'\r\n'):
+        return line[:-2] + b'\n'
+    return line
+
+
+def diff_matches(a, b):
+    # Myers' O((N+M)D) diff of two key lists in linear space, returns the (i, j) pairs of lines kept in both.
+    n, m = len(a), len(b)
+    head = 0
+    while head < n and head < m and a[head] == b[head]:
+        head += 1
+    tail = 0
+    while tail < n - head and tail < m - head and a[n - 1 - tail] == b[m - 1 - tail]:
+        tail += 1
+    matches = [(i, i) for i in range(head)]
+    # a line found on one side only can't be kept, the search runs over the others,
+    # which makes a rewritten region cheap instead of the worst case
+    keys_a = set(a[head:n - tail])
+    keys_b = set(b[head:m - tail])
+    lines_a = [i for i in range(head, n - tail) if a[i] in keys_b]
+    lines_b = [j for j in range(head, m - tail) if b[j] in keys_a]
+    for i, j in myers_matches([a[i] for i in lines_a], [b[j] for j in lines_b]):
+        matches.append((lines_a[i], lines_b[j]))
+    for t in range(tail, 0, -1):
+        matches.append((n - t, m - t))
+    # The LCS is rarely unique, so the changes are moved to a canonical place on each side:
+    # both sides of a merge must pick the same line of a run like 'dddd' when they delete one.
+    changed_a = [True] * n
+    changed_b = [True] * m
+    for i, j in matches:
+        changed_a[i] = False
+        changed_b[j] = False
+    compact_changes(a, changed_a, changed_b)
+    compact_changes(b, changed_b, changed_a)
+    return list(zip([i for i in range(n) if not changed_a[i]], [j for j in range(m) if not changed_b[j]]))
+
+
+def compact_changes(keys, changed, other_changed):
+    # xdiff's change compaction: every group of changed lines is slid up and then down as far as it goes,
+    # merging with the groups it runs into, and ends up at the bottom unless it can sit next to
+    # a change of the other file. Only equal lines trade places, so the matches stay valid.
+    n = len(keys)
+    other_kept = [j for j in range(len(other_changed)) if not other_changed[j]]
+    other_kept.append(len(other_changed))
+
+    def other_gap(k):
+        # whether the other file has changed lines between its k-th kept line and the previous one
+        return other_kept[k] > (other_kept[k - 1] + 1 if k > 0 else 0)
+
+    start = 0
+    kept = 0
+    while True:
+        while start < n and not changed[start]:
+            start += 1
+            kept += 1
+        if start == n:
+            return
+        end = start
+        while end < n and changed[end]:
+            end += 1
+        while True:
+            size = end - start
+            while start > 0 and keys[start - 1] == keys[end - 1]:
+                start -= 1
+                end -= 1
+                kept -= 1
+                changed[start] = True
+                changed[end] = False
+                while start > 0 and changed[start - 1]:
+                    start -= 1
+            earliest_end = end
+            end_matching_other = end if other_gap(kept) else -1
+            while end < n and keys[start] == keys[end]:
+                changed[start] = False
+                changed[end] = True
+                start += 1
+                end += 1
+                kept += 1
+                while end < n and changed[end]:
+                    end += 1
+                if other_gap(kept):
+                    end_matching_other = end
+            if end - start == size:
+                break
+        if end != earliest_end and end_matching_other != -1:
+            while end > end_matching_other:
+                start -= 1
+                end -= 1
+                kept -= 1
+                changed[start] = True
+                changed[end] = False
+        start = end
+
+
+def middle_snake(a, b, a_lo, a_hi, b_lo, b_hi):
+    # Runs the forward and the reverse search until they overlap, only the furthest x of
+    # every diagonal is kept. Returns the edit distance and the snake where the paths meet.
+    n, m = a_hi - a_lo, b_hi - b_lo
+    delta = n - m
+    odd = delta % 2 != 0
+    max_d = (n + m + 1) // 2
+    offset = max_d + 1
+    forward = [0] * (2 * offset + 1)
+    backward = [0] * (2 * offset + 1)
+    for d in range(max_d + 1):
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and forward[offset + k - 1] < forward[offset + k + 1]):
+                x = forward[offset + k + 1]
+            else:
+                x = forward[offset + k - 1] + 1
+            y = x - k
+            start_x, start_y = x, y
+            while x < n and y < m and a[a_lo + x] == b[b_lo + y]:
+                x += 1
+                y += 1
+            forward[offset + k] = x
+            c = delta - k
+            if odd and -(d - 1) <= c <= d - 1 and x + backward[offset + c] >= n:
+                return 2 * d - 1, start_x, start_y, x, y
+        for c in range(-d, d + 1, 2):
+            if c == -d or (c != d and backward[offset + c - 1] < backward[offset + c + 1]):
+                x = backward[offset + c + 1]
+            else:
+                x = backward[offset + c - 1] + 1
+            y = x - c
+            start_x, start_y = x, y
+            while x < n and y < m and a[a_hi - 1 - x] == b[b_hi - 1 - y]:
+                x += 1
+                y += 1
+            backward[offset + c] = x
+            k = delta - c
+            if not odd and -d <= k <= d and x + forward[offset + k] >= n:
+                return 2 * d, n - x, m - y, n - start_x, m - start_y
+    raise Exception("Middle snake not found.")
+
+
+def myers_matches(a, b):
+    # Divide and conquer on the middle snake. Regions and snakes are taken from a stack,
+    # the left region on top, so the matches come out in order.
+    matches = []
+    regions = [(False, 0, len(a), 0, len(b))]
+    while regions:
+        is_snake, a_lo, a_hi, b_lo, b_hi = regions.pop()
+        if is_snake:
+            matches.extend((a_lo + t, b_lo + t) for t in range(a_hi - a_lo))
+            continue
+        n, m = a_hi - a_lo, b_hi - b_lo
+        if n == 0 or m == 0:
+            continue
+        d, x, y, u, v = middle_snake(a, b, a_lo, a_hi, b_lo, b_hi)
+        if d > 1:
+            regions.append((False, a_lo + u, a_hi, b_lo + v, b_hi))
+            regions.append((True, a_lo + x, a_lo + u, b_lo + y, b_lo + v))
+            regions.append((False, a_lo, a_lo + x, b_lo, b_lo + y))
+            continue
+        # at most one line inserted or deleted: everything else matches in order
+        i, j = a_lo, b_lo
+        while i < a_hi and j < b_hi:
+            if a[i] == b[j]:
+                matches.append((i, j))
+                i += 1
+                j += 1
+            elif n > m:
+                i += 1
+            else:
+                j += 1
+    return matches
+
+
+def merge3(base, repo, vendor):
+    # diff3 over lines: runs where all three agree are stable, between them the side
+    # that differs from the base wins, and if both differ (and not the same way) it's a conflict.
+    # Returns (merged lines, number of conflicts), lines untouched by the repo come from the new vendor file.
+    # Changes are placed like git's xdiff places them, but when several diffs of the same length exist
+    # git may keep other lines than Myers' search here does, so a few merges still differ from git merge-file's.
+    base_keys = [line_key(line) for line in base]
+    repo_keys = [line_key(line) for line in repo]
+    vendor_keys = [line_key(line) for line in vendor]
+    in_repo = dict(diff_matches(base_keys, repo_keys))
+    in_vendor = dict(diff_matches(base_keys, vendor_keys))
+    newline = b'\r\n' if vendor and vendor[0].endswith(b'\r\n') else b'\n'
+
+    merged = []
+    conflicts = 0
+    i, j, k = 0, 0, 0
+    while i < len(base) or j < len(repo) or k < len(vendor):
+        if i < len(base) and in_repo.get(i) == j and in_vendor.get(i) == k:
+            merged.append(vendor[k])
+            i, j, k = i + 1, j + 1, k + 1
+            continue
+        io = i
+        while io < len(base) and (in_repo.get(io) is None or in_vendor.get(io) is None):
+            io += 1
+        if io < len(base):
+            jo, ko = in_repo[io], in_vendor[io]
+        else:
+            jo, ko = len(repo), len(vendor)
+        if repo_keys[j:jo] == base_keys[i:io]:
+            merged.extend(vendor[k:ko])
+        elif vendor_keys[k:ko] == base_keys[i:io] or vendor_keys[k:ko] == repo_keys[j:jo]:
+            merged.extend(repo[j:jo])
+        else:
+            conflicts += 1
+            for marker, lines in [(MARKER_REPO, repo[j:jo]), (MARKER_BASE, base[i:io]), (MARKER_SEPARATOR, vendor[k:ko])]:
+                merged.append(marker + newline)
+                merged.extend(lines)
+                if lines and not lines[-1].endswith(b'\n'):
+                    merged.append(newline)
+            merged.append(MARKER_VENDOR + newline)
+        i, j, k = io, jo, ko
+    return merged, conflicts
 
 
 def resolve_conflict(vendor_dir_from, vendor_dir_to, repo_dir, work_dir, file_subject):
@@ -14,46 +236,85 @@ def resolve_conflict(vendor_dir_from, vendor_dir_to, repo_dir, work_dir, file_su
     new_vendor_source = os.path.normpath(os.path.join(vendor_dir_to, file_subject))
     repo_source = os.path.normpath(os.path.join(repo_dir, file_subject))
 
-    fix_cwd = os.path.normpath(os.path.join(work_dir, os.path.dirname(file_subject)))
+    fixed_file_pth = os.path.normpath(os.path.join(work_dir, file_subject))
+    fix_cwd = os.path.dirname(fixed_file_pth)
     if not os.path.exists(fix_cwd):
-        os.makedirs(fix_cwd)
-
-    diff_file_name = '{}.diff'.format(os.path.basename(file_subject))
-    diff_file_pth = os.path.join(fix_cwd, diff_file_name)
-    with open(diff_file_pth, mode='wt') as diff_file:
-        cmdline = '{0} --strip-trailing-cr {1} {2}'.format(DIFF_TOOL, old_vendor_source, repo_source)
-        print("> exec: '{}', stdout: '{}'".format(cmdline, diff_file_pth))
-        exit_code = subprocess.call(cmdline, stdout=diff_file)
-        if exit_code != 1:
-            raise Exception("Unexpected diff-tool exit code: {}".format(exit_code))
-
-    print(80*'-')
-    with open(diff_file_pth, mode='rt') as diff_file:
-        diff_text = diff_file.read()
-    print(diff_text, end='')
-    print(80*'-')
-
-    new_file_name = '{}.new'.format(os.path.basename(file_subject))
-    new_file_pth = os.path.join(fix_cwd, new_file_name)
-    if os.path.exists(new_file_pth):
-        os.remove(new_file_pth)
-    shutil.copy2(new_vendor_source, new_file_pth)
-
-    fixed_file_name = os.path.basename(file_subject)
-    fixed_file_pth = os.path.join(fix_cwd, fixed_file_name)
-    if os.path.exists(fixed_file_pth):
-        os.remove(fixed_file_pth)
-    cmdline = '{0} {1} {2} --output={3}'.format(PATCH_TOOL, new_file_name, diff_file_name, fixed_file_name)
-    print("> exec: '{}' in '{}'".format(cmdline, fix_cwd))
-    subprocess.check_call(cmdline, cwd=fix_cwd)
+        try:
+            os.makedirs(fix_cwd)
+        except OSError:
+            if not os.path.isdir(fix_cwd):
+                raise
 
+    merged, conflicts = merge3(read_lines(old_vendor_source), read_lines(repo_source), read_lines(new_vendor_source))
+    with open(fixed_file_pth, 'wb') as fixed_file:
+        fixed_file.write(b''.join(merged))
+    return fixed_file_pth, conflicts
 
-if __name__ == '__main__':
+
+def report_resolved(fixed_file_pth, conflicts):
+    if conflicts:
+        print("> merge: '{}' - {} conflict(s) left, resolve the marked regions manually".format(fixed_file_pth, conflicts))
+    else:
+        print("> merge: '{}' - merged".format(fixed_file_pth))
+
+
+def resolve_conflict_task(task):
+    return resolve_conflict(*task)
+
+
+def import_upgrade_module():
+    # reports are produced by upgrade.py, so its reader is reused here
+    here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if here not in sys.path:
+        sys.path.insert(0, here)
+    import upgrade
+    return upgrade
+
+
+def resolve_conflicts_batch(vendor_dir_from, vendor_dir_to, repo_dir, work_dir, report_file, jobs):
+    upgrade = import_upgrade_module()
+    subjects = upgrade.UpgradeState.load_from_file(report_file).conflicting_files
+    tasks = [(vendor_dir_from, vendor_dir_to, repo_dir, work_dir, subject) for subject in subjects]
+    if jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results = pool.map(resolve_conflict_task, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [resolve_conflict_task(task) for task in tasks]
+    unresolved = 0
+    for fixed_file_pth, conflicts in results:
+        report_resolved(fixed_file_pth, conflicts)
+        if conflicts:
+            unresolved += 1
+    print("> {} file(s) merged, {} with conflicts".format(len(results), unresolved))
+    return unresolved
+
+
+def make_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('--vendor-from', required=True)
     parser.add_argument('--vendor-to', required=True)
     parser.add_argument('--repo-dir',  required=True)
     parser.add_argument('--work-dir', required=True)
-    parser.add_argument('--subject', required=True)
-    args = parser.parse_args()
-    resolve_conflict(args.vendor_from, args.vendor_to, args.repo_dir, args.work_dir, args.subject)
+    subject = parser.add_mutually_exclusive_group(required=True)
+    subject.add_argument('--subject')
+    subject.add_argument('--report')
+    parser.add_argument('--jobs', type=int, default=multiprocessing.cpu_count())
+    return parser
+
+
+def main(args, context):
+    if args.report:
+        unresolved = resolve_conflicts_batch(args.vendor_from, args.vendor_to, args.repo_dir, args.work_dir, args.report, args.jobs)
+    else:
+        fixed_file_pth, unresolved = resolve_conflict(args.vendor_from, args.vendor_to, args.repo_dir, args.work_dir, args.subject)
+        report_resolved(fixed_file_pth, unresolved)
+    if unresolved:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(make_parser().parse_args(), {})
@@ -0,0 +1,109 @@
+import os.path
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts'))
+
+from resolve_conflict import diff_matches, merge3
+
+
+def lines(text, newline=b'\n'):
+    # one line per character, like the short random cases checked against git merge-file
+    return [c.encode('ascii') + newline for c in text]
+
+
+def conflict(repo, base, vendor, newline=b'\n'):
+    return ([b'<<<<<<< repo' + newline] + repo + [b'||||||| vendor-from' + newline] + base
+        + [b'=======' + newline] + vendor + [b'>>>>>>> vendor-to' + newline])
+
+
+class DiffMatchesTest(unittest.TestCase):
+    def test_deletion_from_a_run_slides_down(self):
+        self.assertEqual(diff_matches(list('dddd'), list('ddd')), [(0, 0), (1, 1), (2, 2)])
+
+    def test_insertion_into_a_run_slides_down(self):
+        self.assertEqual(diff_matches(list('fdd'), list('fddd')), [(0, 0), (1, 1), (2, 2)])
+
+    def test_change_stays_next_to_the_other_side(self):
+        # 'ddd' -> 'xcdd' deletes the first 'd', where the insertion is, not the last one
+        self.assertEqual(diff_matches(list('ddd'), list('xcdd')), [(1, 2), (2, 3)])
+
+
+class Merge3Test(unittest.TestCase):
+    def assertMerged(self, base, repo, vendor, expected):
+        self.assertEqual(merge3(lines(base), lines(repo), lines(vendor)), (lines(expected), 0))
+
+    def test_untouched_repo_takes_vendor(self):
+        self.assertMerged('abc', 'abc', 'axbc', 'axbc')
+
+    def test_untouched_vendor_keeps_repo(self):
+        self.assertMerged('abc', 'abyc', 'abc', 'abyc')
+
+    def test_same_change_on_both_sides(self):
+        self.assertMerged('abc', 'axc', 'axc', 'axc')
+
+    def test_same_deletion_from_a_run_is_applied_once(self):
+        self.assertMerged('fdcfddddf', 'fzcfdddf', 'fdcfdddf', 'fzcfdddf')
+
+    def test_agrees_with_git_merge_file(self):
+        # cases where the choice among equally long diffs used to make the merge differ from git's
+        self.assertMerged('ccfddddfdffc', 'cfdddfdff', 'ccfzydddfdfxfc', 'cfzyddfdfxf')
+        self.assertMerged('ddd', 'xcdd', 'ddcxd', 'xcdcxd')
+        self.assertMerged('dddffc', 'dddfc', 'fdddffcc', 'fdddfcc')
+        self.assertMerged('ccddcff', 'ccddff', 'ccdfdcf', 'ccdfdf')
+        self.assertMerged('dcdcfddd', 'dzcdcfdd', 'dcdccdddd', 'dzcdccddd')
+
+    def test_overlapping_changes_conflict_like_git_merge_file(self):
+        merged, conflicts = merge3(lines('fcfcdf'), lines('fcfczdfx'), lines('ffcdff'))
+        self.assertEqual(conflicts, 1)
+        self.assertEqual(merged, lines('ffczdf') + conflict(lines('x'), [], lines('f')))
+        merged, conflicts = merge3(lines('cdddfccccc'), lines('cdddfcccc'), lines('czdddfccc'))
+        self.assertEqual(conflicts, 1)
+        self.assertEqual(merged, lines('czdddfccc') + conflict(lines('c'), lines('cc'), []))
+
+    def test_conflict_markers(self):
+        merged, conflicts = merge3(lines('abcd'), lines('axd'), lines('ayd'))
+        self.assertEqual(conflicts, 1)
+        self.assertEqual(merged, lines('a') + conflict(lines('x'), lines('bc'), lines('y')) + lines('d'))
+
+    def test_conflicts_are_counted(self):
+        merged, conflicts = merge3(lines('abcde'), lines('xbcdz'), lines('ybcdw'))
+        self.assertEqual(conflicts, 2)
+        self.assertEqual(merged, conflict(lines('x'), lines('a'), lines('y')) + lines('bcd')
+            + conflict(lines('z'), lines('e'), lines('w')))
+
+    def test_crlf_repo_lines_compare_equal(self):
+        # lines untouched by the repo come from the new vendor file, with its line endings
+        base = lines('abc')
+        repo = lines('abc', b'\r\n')
+        vendor = lines('axbc')
+        self.assertEqual(merge3(base, repo, vendor), (vendor, 0))
+
+    def test_crlf_repo_change_is_kept(self):
+        merged, conflicts = merge3(lines('abc'), lines('abyc', b'\r\n'), lines('abc', b'\r\n'))
+        self.assertEqual(conflicts, 0)
+        self.assertEqual(merged, lines('abyc', b'\r\n'))
+
+    def test_crlf_conflict_markers(self):
+        merged, conflicts = merge3(lines('abc', b'\r\n'), lines('axc', b'\r\n'), lines('ayc', b'\r\n'))
+        self.assertEqual(conflicts, 1)
+        self.assertEqual(merged, lines('a', b'\r\n') + conflict(lines('x', b'\r\n'), lines('b', b'\r\n'),
+            lines('y', b'\r\n'), b'\r\n') + lines('c', b'\r\n'))
+
+    def test_missing_trailing_newline(self):
+        base = [b'a\n', b'b']
+        self.assertEqual(merge3(base, [b'x\n', b'b'], base), ([b'x\n', b'b'], 0))
+        self.assertEqual(merge3(base, base, [b'a\n', b'b\n', b'c']), ([b'a\n', b'b\n', b'c'], 0))
+        # 'c' and 'c\n' are different lines, a trailing newline added on one side is a change
+        self.assertEqual(merge3([b'a\n', b'b\n', b'c'], [b'x\n', b'b\n', b'c'], [b'a\n', b'b\n', b'c\n']),
+            ([b'x\n', b'b\n', b'c\n'], 0))
+
+    def test_missing_trailing_newline_in_conflict(self):
+        # a conflicting last line without a newline still gets its marker on a line of its own
+        merged, conflicts = merge3([b'a\n', b'b'], [b'a\n', b'x'], [b'a\n', b'y'])
+        self.assertEqual(conflicts, 1)
+        self.assertEqual(merged, [b'a\n'] + conflict([b'x', b'\n'], [b'b', b'\n'], [b'y', b'\n']))
+
+
+if __name__ == '__main__':
+    unittest.main()
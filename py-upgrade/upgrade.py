@@ -1,19 +1,47 @@
 from __future__ import print_function
 import argparse
+import binascii
 import sys
 if sys.version_info.major < 3:
     import ConfigParser as configparser
+    import Queue as queue
 else:
     import configparser
+    import queue
 import io
 import hashlib
+import heapq
 import mimetypes
+import mmap
+import multiprocessing
 import os.path
+import shlex
 import shutil
+import struct
 import subprocess
+import tempfile
+import threading
+import time
+import traceback
 
 
 ROOT_KEY = '<root>'
+STATE_HEADER_DIGEST = '# digest: '
+STATE_BINARY_MAGIC = b'PRJSTATE'
+STATE_BINARY_VERSION = 2
+STATE_RECORD_HAS_STAT = 0x01
+STATE_FORMAT_BINARY = 'binary'
+STATE_FORMAT_TEXT = 'text'
+STATE_FORMATS = [STATE_FORMAT_BINARY, STATE_FORMAT_TEXT]
+STATE_FORMAT = STATE_FORMAT_BINARY
+_STATE_BINARY_HEADER = struct.Struct('<8sHBB')
+_STATE_BINARY_COUNT = struct.Struct('<Q')
+_STATE_BINARY_RECORD = struct.Struct('<HHcB')
+_STATE_BINARY_STAT = struct.Struct('<QqQ')
+_STATE_BINARY_LAYOUT = struct.Struct('<QQQQQ')
+_STATE_BINARY_OFFSET = struct.Struct('<Q')
+_STATE_BINARY_KEY_SPAN = struct.Struct('<QQ')
+_STATE_BINARY_ENTRY = struct.Struct('<cB')
 TYPE_DIR = 'd'
 TYPE_FILE = 'f'
 
@@ -24,6 +52,15 @@ CHANGE_STATUS_ITEM_DELETED  = 0x0004
 CHANGE_STATUS_SEEDING       = 0x0008
 CHANGE_STATUS_INHERITED     = 0x0010
 
+HASH_CHUNK_SIZE = 1024 * 1024
+# files modified this close to the scan may still change within the same mtime tick, their stats aren't kept
+RACY_MTIME_WINDOW_NS = 2 * 1000000000
+
+DEFAULT_DIGEST_ALGORITHM = 'md5'
+XXHASH_ALGORITHMS = ('xxh32', 'xxh64', 'xxh128', 'xxh3_64', 'xxh3_128')
+DIGEST_ALGORITHM = DEFAULT_DIGEST_ALGORITHM
+_digest_factory = hashlib.md5
+
 
 def _to_string(v):
     if sys.version_info[0] < 3:
@@ -36,50 +73,127 @@ def _to_string(v):
         return str(v)
 
 
-def is_item_type_recursive(tp_name):
-    return (tp_name == TYPE_DIR)
+def _to_utf8(v):
+    if isinstance(v, bytes):
+        return v
+    return v.encode('utf-8')
 
 
-class FileTreeNode:
-    def __init__(self, local_id, parent_key = None):
-        self.local_id = id
-        if (parent_key is None) or (parent_key == ROOT_KEY):
-            self.node_key = local_id
-        else:
-            self.node_key = '/'.join([parent_key, local_id])
-        self.children = {}
+def make_digest_factory(name):
+    if name in XXHASH_ALGORITHMS:
+        try:
+            import xxhash
+        except ImportError:
+            raise Exception("Digest algorithm '{}' requires the 'xxhash' module.".format(name))
+        return getattr(xxhash, name)
+    try:
+        hashlib.new(name).hexdigest()
+    except (ValueError, TypeError):
+        raise Exception("Digest algorithm '{}' is not supported by this Python.".format(name))
+    factory = getattr(hashlib, name, None)
+    if factory is None:
+        factory = lambda: hashlib.new(name)
+    return factory
+
+
+def set_digest_algorithm(name):
+    global DIGEST_ALGORITHM
+    global _digest_factory
+    _digest_factory = make_digest_factory(name)
+    DIGEST_ALGORITHM = name
+
+
+def new_digest():
+    return _digest_factory()
+
+
+def set_state_format(name):
+    if name not in STATE_FORMATS:
+        raise Exception("Unknown state format '{}', expected one of: {}.".format(name, ', '.join(STATE_FORMATS)))
+    global STATE_FORMAT
+    STATE_FORMAT = name
 
-    def get_child(self, id):
-        ret = self.children.get(id)
-        if ret is None:
-            raise Exception("Node '{}' doesn't have child named '{}'.".format(self.id, id))
-        return ret
 
-    def add_child(self, id):
-        if id in self.children:
-            raise Exception("Child named '{}' already added in node '{}'.".format(id, self.id))
-        self.children[id] = FileTreeNode(id, self.node_key)
+def _intern(v):
+    if sys.version_info[0] < 3:
+        if isinstance(v, unicode):
+            return v
+        return intern(v)
+    return sys.intern(v)
+
+
+def is_item_type_recursive(tp_name):
+    return (tp_name == TYPE_DIR)
+
+
+class FileTreeNode(object):
+    __slots__ = ('node_name', 'parent', 'children')
+
+    def __init__(self, name, parent=None):
+        self.node_name = _intern(name)
+        self.parent = parent
+        self.children = None
+
+    @property
+    def node_key(self):
+        if self.parent is None:
+            return self.node_name
+        bits = []
+        node = self
+        while node.parent is not None:
+            bits.append(node.node_name)
+            node = node.parent
+        bits.reverse()
+        return '/'.join(bits)
+
+    def get_child(self, name):
+        children = self.children or []
+        lo, hi = 0, len(children)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if children[mid].node_name < name:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == len(children) or children[lo].node_name != name:
+            raise Exception("Node '{}' doesn't have child named '{}'.".format(self.node_key, name))
+        return children[lo]
+
+    def add_child(self, name):
+        # children are kept ordered by name, so they have to be added in that order
+        if self.children is None:
+            self.children = []
+        if self.children and self.children[-1].node_name >= name:
+            raise Exception("Child named '{}' added out of order in node '{}'.".format(name, self.node_key))
+        child = FileTreeNode(name, self)
+        self.children.append(child)
+        return child
 
     def select_keys_of_children(self):
-        ret = set()
-        for k in sorted(self.children.keys()):
-            c = self.children[k]
-            ret.add(c.node_key)
-        return ret
+        if not self.children:
+            return []
+        if self.parent is None:
+            prefix = ''
+        else:
+            prefix = self.node_key + '/'
+        return [prefix + c.node_name for c in self.children]
 
 
 def mkfs(nodes):
+    # In sorted key order a parent precedes its children and siblings come by name,
+    # so a single pass appends every node at its final position.
     root = FileTreeNode(ROOT_KEY)
+    dirs = {ROOT_KEY: root}
     for key in sorted(nodes.keys()):
         if key == ROOT_KEY:
             continue
         _a, _b, _c = key.rpartition('/')
-        parent = root
-        subject = _c
-        if _a:
-            for bit in _a.split('/'):
-                parent = parent.get_child(bit)
-        parent.add_child(subject)
+        parent = dirs.get(_a or ROOT_KEY)
+        if parent is None:
+            raise Exception("Parent of item '{}' is missing.".format(key))
+        node = parent.add_child(_c)
+        if is_item_type_recursive(nodes[key].src_type):
+            dirs[key] = node
     return root
 
 
@@ -87,12 +201,25 @@ class ProjectState:
     def __init__(self, nodes):
         if not nodes:
             nodes = {}
-            nodes[ROOT_KEY] = Source(ROOT_KEY, TYPE_DIR, hashlib.md5().hexdigest())
+            nodes[ROOT_KEY] = Source(ROOT_KEY, TYPE_DIR, new_digest().hexdigest())
         self.nodes = nodes
         self.fs = mkfs(nodes)
 
+    def close(self):
+        pass
+
     def write(self, filename):
+        tmp_filename = filename + '.tmp'
+        if STATE_FORMAT == STATE_FORMAT_TEXT:
+            self.write_text(tmp_filename)
+        else:
+            write_state_binary(tmp_filename, self.nodes)
+        replace_file(tmp_filename, filename)
+
+
+    def write_text(self, filename):
         with io.open(filename, mode='wt', encoding='utf8') as f:
+            f.write(_to_string('{}{}\n'.format(STATE_HEADER_DIGEST, DIGEST_ALGORITHM)))
             f.write(_to_string('{\n'))
             for k in sorted(self.nodes.keys()):
                 f.writelines([_to_string(self.nodes[k]), _to_string('\n')])
@@ -112,14 +239,27 @@ class ProjectState:
         return fs_node.select_keys_of_children()
 
 
-class Source:
-    def __init__(self, archive_path, src_type, digest):
+class Source(object):
+    __slots__ = ('archive_path', 'src_type', '_digest', 'stat')
+
+    def __init__(self, archive_path, src_type, digest, stat=None):
         self.archive_path = archive_path
         self.src_type = src_type
         self.digest = digest
+        self.stat = stat
+
+    @property
+    def digest(self):
+        return binascii.hexlify(self._digest).decode('ascii')
+
+    @digest.setter
+    def digest(self, value):
+        self._digest = binascii.unhexlify(value)
 
     def __str__(self):
-        return "    '{}' : ('{}', '{}'),".format(self.archive_path, self.src_type, self.digest)
+        if self.stat is None:
+            return "    '{}' : ('{}', '{}'),".format(self.archive_path, self.src_type, self.digest)
+        return "    '{}' : ('{}', '{}', {}, {}, {}),".format(self.archive_path, self.src_type, self.digest, *self.stat)
 
 
 class FSSelector:
@@ -162,14 +302,201 @@ def make_rel_path(bits, tail):
     return '/'.join(parts)
 
 
-def md5_of_file(path):
-    m = hashlib.md5()
-    data = io.FileIO(path).readall().replace(b'\r\n', b'\n').rstrip(b'\r\n')
-    m.update(data)
+def digest_of_file(path):
+    # Same digest as hash of data.replace(b'\r\n', b'\n').rstrip(b'\r\n'), computed chunk by chunk:
+    # a trailing '\r' is carried into the next chunk so CRLF pairs are never split,
+    # and a trailing run of line breaks is held back until more content follows it.
+    m = new_digest()
+    carry = b''
+    held_tail = b''
+    with io.open(path, mode='rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            data = carry + chunk
+            if data.endswith(b'\r'):
+                carry = b'\r'
+                data = data[:-1]
+            else:
+                carry = b''
+            data = data.replace(b'\r\n', b'\n')
+            body = data.rstrip(b'\r\n')
+            if body:
+                m.update(held_tail)
+                m.update(body)
+                held_tail = data[len(body):]
+            else:
+                held_tail += data
     return m.hexdigest()
 
 
-def enum_fs_content_recursive(seed, selector, outbox, pathbits):
+def stat_key_of(st):
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1000000000)
+    return (st.st_size, mtime_ns, st.st_ino)
+
+
+def time_ns():
+    if hasattr(time, 'time_ns'):
+        return time.time_ns()
+    return int(time.time() * 1000000000)
+
+
+class StatCache:
+    def __init__(self, nodes, scan_started_ns):
+        self._nodes = nodes
+        self._racy_since_ns = scan_started_ns - RACY_MTIME_WINDOW_NS
+
+    def lookup(self, arch_path, stat_key):
+        src = self._nodes.get(arch_path) if self._nodes else None
+        if src is None or src.src_type != TYPE_FILE or src.stat is None:
+            return None
+        if src.stat != stat_key:
+            return None
+        return src.digest
+
+    def cacheable(self, stat_key):
+        return stat_key[1] < self._racy_since_ns
+
+
+def digest_of_digests(digests):
+    dsum = new_digest()
+    for s in digests:
+        dsum.update(s.encode())
+    return dsum.hexdigest()
+
+
+class PendingDigest(object):
+    __slots__ = ('_done', '_value', '_error')
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._value = None
+        self._error = None
+
+    def resolve(self):
+        self._done.wait()
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+
+class PendingDirDigest(object):
+    __slots__ = ('_digests', '_value')
+
+    def __init__(self, digests):
+        self._digests = digests
+        self._value = None
+
+    def resolve(self):
+        if self._value is None:
+            self._value = digest_of_digests([resolve_digest(d) for d in self._digests])
+            self._digests = None
+        return self._value
+
+
+def resolve_digest(digest):
+    if isinstance(digest, (PendingDigest, PendingDirDigest)):
+        return digest.resolve()
+    return digest
+
+
+class SerialHasher:
+    def __init__(self, progress=None):
+        self.progress = progress
+
+    def file_digest(self, path, size):
+        digest = digest_of_file(path)
+        if self.progress is not None:
+            self.progress.add_bytes(size)
+        return digest
+
+
+class HashingPool:
+    # Worker threads shared by all the trees scanned at once, their number is the global limit.
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self._inbox = queue.Queue()
+        self._workers = []
+        for _ in range(jobs):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, pending, path, size, hasher):
+        self._inbox.put((pending, path, size, hasher))
+
+    def close(self):
+        for _ in self._workers:
+            self._inbox.put(None)
+        for worker in self._workers:
+            worker.join()
+
+    def _work(self):
+        while True:
+            task = self._inbox.get()
+            if task is None:
+                return
+            pending, path, size, hasher = task
+            try:
+                pending._value = digest_of_file(path)
+            except Exception as e:
+                pending._error = e
+            hasher.on_hashed(size)
+            pending._done.set()
+
+
+class PooledHasher:
+    # A tree's share of a HashingPool: no more than `budget` of its files wait in the pool at a time,
+    # so a tree can't crowd the others out of the workers.
+    def __init__(self, pool, budget, progress=None):
+        self.progress = progress
+        self._pool = pool
+        self._budget = threading.BoundedSemaphore(budget)
+
+    def file_digest(self, path, size):
+        self._budget.acquire()
+        pending = PendingDigest()
+        self._pool.submit(pending, path, size, self)
+        return pending
+
+    def on_hashed(self, size):
+        self._budget.release()
+        if self.progress is not None:
+            self.progress.add_bytes(size)
+
+
+class ScanProgress:
+    def __init__(self, name):
+        self.name = name
+        self.files = 0
+        self.hashed_bytes = 0
+        self.started = time.time()
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def add_file(self):
+        self.files += 1
+
+    def add_bytes(self, size):
+        with self._lock:
+            self.hashed_bytes += size
+
+    def finish(self):
+        self.finished = time.time()
+
+    def __str__(self):
+        elapsed = max((self.finished or time.time()) - self.started, 0.001)
+        megabytes = self.hashed_bytes / (1024.0 * 1024.0)
+        return '{}: {} files, {:.1f} MB hashed ({:.0f} files/s, {:.1f} MB/s)'.format(self.name, self.files, megabytes,
+            self.files / elapsed, megabytes / elapsed)
+
+
+def enum_fs_content_recursive(seed, selector, outbox, pathbits, stat_cache, hasher, progress):
+    # Entries go to the outbox as (type, digest, stat), digests may still be pending there.
     if pathbits:
         fs_path = os.path.join(seed, *pathbits)
         if len(pathbits) > 1:
@@ -182,9 +509,15 @@ def enum_fs_content_recursive(seed, selector, outbox, pathbits):
     is_dir = os.path.isdir(fs_path)
     if not is_dir:
         arch_path = '/'.join(pathbits)
-        fsum = md5_of_file(fs_path)
-        item = Source(arch_path, TYPE_FILE, fsum)
-        outbox[arch_path] = item
+        stat_key = stat_key_of(os.stat(fs_path))
+        fsum = stat_cache.lookup(arch_path, stat_key)
+        if fsum is None:
+            fsum = hasher.file_digest(fs_path, stat_key[0])
+        if not stat_cache.cacheable(stat_key):
+            stat_key = None
+        if progress is not None:
+            progress.add_file()
+        outbox[arch_path] = (TYPE_FILE, fsum, stat_key)
         return fsum
 
     files = []
@@ -195,39 +528,46 @@ def enum_fs_content_recursive(seed, selector, outbox, pathbits):
             dirs.append(name)
         else:
             files.append(name)
-    dsum = hashlib.md5()
+    digests = []
     for name in sorted(files):
         rel_path = make_rel_path(pathbits, name)
         if not selector.file_in_interest(name, rel_path):
             continue
         pathbits.append(name)
-        s = enum_fs_content_recursive(seed, selector, outbox, pathbits)
+        s = enum_fs_content_recursive(seed, selector, outbox, pathbits, stat_cache, hasher, progress)
         del pathbits[-1]
-        dsum.update(s.encode())
+        digests.append(s)
     for name in sorted(dirs):
         rel_path = make_rel_path(pathbits, name)
         if not selector.dir_in_interest(name, rel_path):
             continue
         pathbits.append(name)
-        s = enum_fs_content_recursive(seed, selector, outbox, pathbits)
+        s = enum_fs_content_recursive(seed, selector, outbox, pathbits, stat_cache, hasher, progress)
         del pathbits[-1]
-        dsum.update(s.encode())
+        digests.append(s)
 
-    dir_digest = dsum.hexdigest()
+    if any(isinstance(s, (PendingDigest, PendingDirDigest)) for s in digests):
+        dir_digest = PendingDirDigest(digests)
+    else:
+        dir_digest = digest_of_digests(digests)
     if pathbits:
         arch_path = '/'.join(pathbits)
-        item = Source(arch_path, TYPE_DIR, dir_digest)
-        outbox[arch_path] = item
+        outbox[arch_path] = (TYPE_DIR, dir_digest, None)
     else:
-        outbox[ROOT_KEY] = Source(ROOT_KEY, TYPE_DIR, dir_digest)
+        outbox[ROOT_KEY] = (TYPE_DIR, dir_digest, None)
     return dir_digest
 
 
-def enum_fs_content(seed, selector):
+def enum_fs_content(seed, selector, cached_nodes=None, hasher=None, progress=None):
     pathbits = []
     outbox = {}
-    enum_fs_content_recursive(seed, selector, outbox, pathbits)
-    return outbox
+    if hasher is None:
+        hasher = SerialHasher(progress)
+    enum_fs_content_recursive(seed, selector, outbox, pathbits, StatCache(cached_nodes, time_ns()), hasher, progress)
+    nodes = {}
+    for arch_path, (src_type, digest, stat_key) in outbox.items():
+        nodes[arch_path] = Source(arch_path, src_type, resolve_digest(digest), stat_key)
+    return nodes
 
 
 def load_py_data(filename):
@@ -236,7 +576,7 @@ def load_py_data(filename):
     return eval(ast, {'__builtins__': None}, {})
 
     
-def load_project(project_root, file_exclusions=None, dir_exclusions=None):
+def load_project(project_root, file_exclusions=None, dir_exclusions=None, cached_nodes=None, hasher=None, progress=None):
     selector = FSSelector()
 
     if file_exclusions:
@@ -247,21 +587,236 @@ def load_project(project_root, file_exclusions=None, dir_exclusions=None):
         for rel_path in dir_exclusions:
             selector.add_dir_relpath_to_exclusions(rel_path)
 
-    nodes = enum_fs_content(project_root, selector)
+    nodes = enum_fs_content(project_root, selector, cached_nodes, hasher, progress)
     return ProjectState(nodes)
 
 
+def replace_file(src, dst):
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+        return
+    if os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+
+def write_state_binary(filename, nodes, with_stats=True):
+    algorithm = _to_utf8(DIGEST_ALGORITHM)
+    digest_size = new_digest().digest_size
+    items = sorted(((_to_utf8(k), src) for k, src in nodes.items()), key=lambda item: item[0])
+    count = len(items)
+    has_stats = with_stats and any(src.stat is not None for _, src in items)
+    index_offset = _STATE_BINARY_HEADER.size + len(algorithm) + _STATE_BINARY_LAYOUT.size
+    entries_offset = index_offset + (count + 1) * _STATE_BINARY_OFFSET.size
+    stats_offset = entries_offset + count * (_STATE_BINARY_ENTRY.size + digest_size)
+    keys_offset = stats_offset
+    if has_stats:
+        keys_offset += count * _STATE_BINARY_STAT.size
+    else:
+        stats_offset = 0
+    with io.open(filename, mode='wb') as f:
+        f.write(_STATE_BINARY_HEADER.pack(STATE_BINARY_MAGIC, STATE_BINARY_VERSION, digest_size, len(algorithm)))
+        f.write(algorithm)
+        f.write(_STATE_BINARY_LAYOUT.pack(count, index_offset, entries_offset, stats_offset, keys_offset))
+        # every section is written record by record, the file buffer batches the small writes
+        position = 0
+        for key, _ in items:
+            f.write(_STATE_BINARY_OFFSET.pack(position))
+            position += len(key)
+        f.write(_STATE_BINARY_OFFSET.pack(position))
+        for _, src in items:
+            flags = STATE_RECORD_HAS_STAT if has_stats and src.stat is not None else 0
+            f.write(_STATE_BINARY_ENTRY.pack(_to_utf8(src.src_type), flags))
+            f.write(src._digest)
+        if has_stats:
+            for _, src in items:
+                f.write(_STATE_BINARY_STAT.pack(*(src.stat or (0, 0, 0))))
+        for key, _ in items:
+            f.write(key)
+
+
+def read_state_binary_header(f, state_file):
+    magic, version, digest_size, algorithm_size = _STATE_BINARY_HEADER.unpack(f.read(_STATE_BINARY_HEADER.size))
+    if version > STATE_BINARY_VERSION:
+        raise Exception("State file '{}' has unsupported format version {}.".format(state_file, version))
+    algorithm = f.read(algorithm_size).decode('utf-8')
+    return version, algorithm, digest_size
+
+
+def iter_state_binary_records(state_file):
+    # Version 1 layout: a stream of prefix-compressed records.
+    with io.open(state_file, mode='rb') as f:
+        _, _, digest_size = read_state_binary_header(f, state_file)
+        count, = _STATE_BINARY_COUNT.unpack(f.read(_STATE_BINARY_COUNT.size))
+        key = b''
+        for _ in range(count):
+            shared, suffix_size, type_code, flags = _STATE_BINARY_RECORD.unpack(f.read(_STATE_BINARY_RECORD.size))
+            tail = f.read(suffix_size + digest_size)
+            key = key[:shared] + tail[:suffix_size]
+            digest = binascii.hexlify(tail[suffix_size:]).decode('ascii')
+            stat_key = None
+            if flags & STATE_RECORD_HAS_STAT:
+                stat_key = _STATE_BINARY_STAT.unpack(f.read(_STATE_BINARY_STAT.size))
+            yield key.decode('utf-8'), type_code.decode('ascii'), digest, stat_key
+
+
+class MappedStateIndex:
+    # Version 2 layout: fixed-width key offsets and entries, followed by the keys sorted bytewise.
+    def __init__(self, state_file):
+        self._file = io.open(state_file, mode='rb')
+        try:
+            _, _, self._digest_size = read_state_binary_header(self._file, state_file)
+            layout = _STATE_BINARY_LAYOUT.unpack(self._file.read(_STATE_BINARY_LAYOUT.size))
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except:
+            self._file.close()
+            raise
+        self._count, self._index_offset, self._entries_offset, self._stats_offset, self._keys_offset = layout
+        self._entry_size = _STATE_BINARY_ENTRY.size + self._digest_size
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, key):
+        return self._find(key) >= 0
+
+    def __getitem__(self, key):
+        src = self.get(key)
+        if src is None:
+            raise KeyError(key)
+        return src
+
+    def get(self, key, default=None):
+        i = self._find(key)
+        if i < 0:
+            return default
+        return self._source_at(i, key)
+
+    def keys(self):
+        for i in range(self._count):
+            yield self._key_at(i).decode('utf-8')
+
+    def values(self):
+        for i in range(self._count):
+            yield self._source_at(i)
+
+    def items(self):
+        for i in range(self._count):
+            src = self._source_at(i)
+            yield src.archive_path, src
+
+    def select_keys_of_children(self, parent_key):
+        ret = []
+        if parent_key == ROOT_KEY:
+            prefix = b''
+        else:
+            prefix = _to_utf8(parent_key) + b'/'
+        root_key = _to_utf8(ROOT_KEY)
+        i = self._lower_bound(prefix)
+        while i < self._count:
+            key = self._key_at(i)
+            if not key.startswith(prefix):
+                break
+            slash = key.find(b'/', len(prefix))
+            if slash < 0:
+                if key != root_key:
+                    ret.append(key.decode('utf-8'))
+                i += 1
+            else:
+                # skip the whole subtree of this child: '0' is the byte right after '/'
+                i = self._lower_bound(key[:slash] + b'0', i)
+        return ret
+
+    def _key_at(self, i):
+        start, end = _STATE_BINARY_KEY_SPAN.unpack_from(self._map, self._index_offset + i * _STATE_BINARY_OFFSET.size)
+        return self._map[self._keys_offset + start:self._keys_offset + end]
+
+    def _lower_bound(self, key, lo=0):
+        hi = self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _find(self, key):
+        key = _to_utf8(key)
+        i = self._lower_bound(key)
+        if i < self._count and self._key_at(i) == key:
+            return i
+        return -1
+
+    def _source_at(self, i, key=None):
+        offset = self._entries_offset + i * self._entry_size
+        type_code, flags = _STATE_BINARY_ENTRY.unpack_from(self._map, offset)
+        digest = binascii.hexlify(self._map[offset + _STATE_BINARY_ENTRY.size:offset + self._entry_size]).decode('ascii')
+        stat_key = None
+        if flags & STATE_RECORD_HAS_STAT:
+            stat_key = _STATE_BINARY_STAT.unpack_from(self._map, self._stats_offset + i * _STATE_BINARY_STAT.size)
+        if key is None:
+            key = self._key_at(i).decode('utf-8')
+        return Source(key, type_code.decode('ascii'), digest, stat_key)
+
+
+class MappedProjectState:
+    def __init__(self, state_file):
+        self.nodes = MappedStateIndex(state_file)
+
+    def close(self):
+        self.nodes.close()
+
+    def select_keys_of_children(self, parent_key):
+        return self.nodes.select_keys_of_children(parent_key)
+
+
+def is_binary_state_file(state_file):
+    with io.open(state_file, mode='rb') as f:
+        return f.read(len(STATE_BINARY_MAGIC)) == STATE_BINARY_MAGIC
+
+
+def read_state_digest_algorithm(state_file):
+    if is_binary_state_file(state_file):
+        with io.open(state_file, mode='rb') as f:
+            _, algorithm, _ = read_state_binary_header(f, state_file)
+        return algorithm
+    with io.open(state_file, mode='rt', encoding='utf8') as f:
+        header = f.readline().rstrip('\n')
+    if header.startswith(STATE_HEADER_DIGEST):
+        return header[len(STATE_HEADER_DIGEST):].strip()
+    return DEFAULT_DIGEST_ALGORITHM
+
+
 def load_project_from_state_file(state_file):
+    algorithm = read_state_digest_algorithm(state_file)
+    if algorithm != DIGEST_ALGORITHM:
+        raise Exception("State file '{}' holds '{}' digests, but '{}' is configured, re-create it with '--mode init'.".format(state_file, algorithm, DIGEST_ALGORITHM))
     nodes = {}
+    if is_binary_state_file(state_file):
+        with io.open(state_file, mode='rb') as f:
+            version, _, _ = read_state_binary_header(f, state_file)
+        if version >= 2:
+            return MappedProjectState(state_file)
+        for k, tpname, digest, stat_key in iter_state_binary_records(state_file):
+            nodes[k] = Source(k, tpname, digest, stat_key)
+        return ProjectState(nodes)
     flat = load_py_data(state_file)
     for k, v in flat.items():
         tpname, digest = v[0], v[1]
-        src = Source(k, tpname, digest)
+        stat_key = tuple(v[2:5]) if len(v) >= 5 else None
+        src = Source(k, tpname, digest, stat_key)
         nodes[k] = src
     return ProjectState(nodes)
 
 
-class ChangeNode:
+class ChangeNode(object):
+    __slots__ = ('item_type', 'archive_path', 'flags')
+
     def __init__(self, item_type, archive_path, flags):
         self.item_type = item_type
         self.archive_path = archive_path
@@ -303,7 +858,7 @@ class ChangeSet:
         self.changes.append(node)
         if item_recursive:
             children = ctx.select_keys_of_children(src.archive_path)
-            for child in sorted(children):
+            for child in children:
                 child_src = ctx.nodes[child]
                 self.on_deleted(child_src, ctx, True)
 
@@ -318,7 +873,7 @@ class ChangeSet:
         self.changes.append(node)
         if item_recursive:
             children = ctx.select_keys_of_children(src.archive_path)
-            for child in sorted(children):
+            for child in children:
                 child_src = ctx.nodes[child]
                 self.on_created(child_src, ctx, True)
 
@@ -327,6 +882,25 @@ class ChangeSet:
         self.changes.append(node)
 
 
+def merge_sorted_keys(a, b):
+    i, j = 0, 0
+    while i < len(a) and j < len(b):
+        if a[i] == b[j]:
+            yield a[i]
+            i += 1
+            j += 1
+        elif a[i] < b[j]:
+            yield a[i]
+            i += 1
+        else:
+            yield b[j]
+            j += 1
+    for k in a[i:]:
+        yield k
+    for k in b[j:]:
+        yield k
+
+
 def eval_diff_recursive(key, p, n, outbox):
     src_p = p.nodes.get(key)
     src_n = n.nodes.get(key)
@@ -370,22 +944,77 @@ def eval_diff_recursive(key, p, n, outbox):
         outbox[key] = changes
         return
 
-    keys_of_children = p.select_keys_of_children(key) | n.select_keys_of_children(key)
-
-    for k in sorted(keys_of_children):
+    for k in merge_sorted_keys(p.select_keys_of_children(key), n.select_keys_of_children(key)):
         eval_diff_recursive(k, p, n, outbox)
 
 
-def eval_projects_diff(prev, now):
+def flatten_change_sets(changes):
     result = []
-    changes = {}
-    eval_diff_recursive(ROOT_KEY, prev, now, changes)
     for k in sorted(changes.keys()):
         chset = changes[k]
         result += chset.changes
     return result
 
 
+def eval_projects_diff(prev, now):
+    changes = {}
+    eval_diff_recursive(ROOT_KEY, prev, now, changes)
+    return flatten_change_sets(changes)
+
+
+def is_same_source(a, b):
+    if a is None or b is None:
+        return a is b
+    return a.src_type == b.src_type and a._digest == b._digest
+
+
+def eval_diff3_recursive(key, base, vendor, repo, vendor_outbox, repo_outbox, conflicts):
+    src_b = base.nodes.get(key)
+    src_v = vendor.nodes.get(key)
+    src_r = repo.nodes.get(key)
+    vendor_same = is_same_source(src_b, src_v)
+    repo_same = is_same_source(src_b, src_r)
+
+    if repo_same:
+        if not vendor_same:
+            eval_diff_recursive(key, base, vendor, vendor_outbox)
+        return
+    if vendor_same:
+        eval_diff_recursive(key, base, repo, repo_outbox)
+        return
+
+    if all(src is not None and is_item_type_recursive(src.src_type) for src in (src_b, src_v, src_r)):
+        children = merge_sorted_keys(list(merge_sorted_keys(base.select_keys_of_children(key), vendor.select_keys_of_children(key))),
+            repo.select_keys_of_children(key))
+        for k in children:
+            eval_diff3_recursive(k, base, vendor, repo, vendor_outbox, repo_outbox, conflicts)
+        return
+
+    # both sides changed this very item, every repo change below collides with the vendor's
+    vendor_changes = {}
+    repo_changes = {}
+    eval_diff_recursive(key, base, vendor, vendor_changes)
+    eval_diff_recursive(key, base, repo, repo_changes)
+    markers = set(chset.archive_path for chset in flatten_change_sets(repo_changes))
+    for chset in flatten_change_sets(vendor_changes):
+        if chset.archive_path in markers:
+            conflicts.add(chset.archive_path)
+    vendor_outbox.update(vendor_changes)
+    repo_outbox.update(repo_changes)
+
+
+def eval_projects_diff3(base, vendor, repo):
+    # One walk over the three states: subtrees equal on all sides are skipped, subtrees only
+    # one side touched get a plain two-way diff, so the work follows the size of the changes.
+    # Returns the vendor changes and the repo changes as eval_projects_diff would, and the set of
+    # paths both sides changed.
+    vendor_changes = {}
+    repo_changes = {}
+    conflicts = set()
+    eval_diff3_recursive(ROOT_KEY, base, vendor, repo, vendor_changes, repo_changes, conflicts)
+    return flatten_change_sets(vendor_changes), flatten_change_sets(repo_changes), conflicts
+
+
 # ============================================================================================================================
 # ============================================================================================================================
 # ============================================================================================================================
@@ -446,6 +1075,13 @@ TAG_DIR_FROM = 'DIR_FROM'
 TAG_DIR_TO = 'DIR_TO'
 TAG_DIR_REPO = 'DIR_REPO'
 TAG_DIR_CACHE = 'DIR_CACHE'
+TAG_DIR_DIGEST_CACHE = 'DIR_DIGEST_CACHE'
+TAG_TARBALL_FROM = 'TARBALL_FROM'
+TAG_TARBALL_TO = 'TARBALL_TO'
+TAG_SCAN_JOBS = 'SCAN_JOBS'
+TAG_LINK_MODE = 'LINK_MODE'
+TAG_DIGEST = 'DIGEST'
+TAG_STATE_FORMAT = 'STATE_FORMAT'
 TAG_STATE_FILE_FROM = 'STATE_FILE_FROM'
 TAG_STATE_FILE_TO = 'STATE_FILE_TO'
 TAG_STATE_FILE_REPO = 'STATE_FILE_REPO'
@@ -453,6 +1089,8 @@ TAG_UPGRADE_REPORT_FILE = 'UPGRADE_REPORT_FILE'
 TAG_DIR_CONFLITS_WORK = 'DIR_CONFLITS_WORK'
 TAG_RESOLVED_CONFLICTS_CACHE_FILE = 'RESOLVED_CONFLICTS_CACHE_FILE'
 TAG_UPGRADE_CACHE_FILE = 'UPGRADE_CACHE_FILE'
+TAG_PROGRESS_SYNC_ITEMS = 'PROGRESS_SYNC_ITEMS'
+TAG_PROGRESS_SYNC_MS = 'PROGRESS_SYNC_MS'
 
 TAG_SANITIZE = 'SANITIZE'
 TAG_FILES_REPO_PRIVATE = 'FILES_REPO_PRIVATE'
@@ -468,6 +1106,8 @@ TAG_CMD_FILE_DELETE = 'FILE_DELETE'
 TAG_CMD_FILE_MODIFY = 'FILE_MODIFY'
 TAG_CMD_FILE_MODIFY_CONFLICTED = 'FILE_MODIFY_CONFLICTED'
 TAG_CMD_RESOLVE_CONFLICT = 'RESOLVE_CONFLICT'
+TAG_CMD_EXECUTOR = 'EXECUTOR'
+TAG_CMD_JOBS = 'JOBS'
 
 
 def ensure_repo_sanitized(config):
@@ -509,15 +1149,145 @@ def load_config(conf_file):
     config.read(conf_path)
     global DIR_HOME
     DIR_HOME = os.path.dirname(conf_path)
+    set_digest_algorithm(get_conf_string0(config, TAG_CONFIG, TAG_DIGEST) or DEFAULT_DIGEST_ALGORITHM)
+    set_state_format(get_conf_string0(config, TAG_CONFIG, TAG_STATE_FORMAT) or STATE_FORMAT_BINARY)
     return config
 
 
-def scan_project(scan_root, output, file_exclusions=None, dir_exclusions=None):
+def load_cached_project(state_file):
+    # A previous state of the same tree: files whose stats didn't change keep their digests.
+    if not os.path.exists(state_file) or read_state_digest_algorithm(state_file) != DIGEST_ALGORITHM:
+        return None
+    return load_project_from_state_file(state_file)
+
+
+def scan_project(scan_root, output, file_exclusions=None, dir_exclusions=None, reuse_digests=False, hasher=None, progress=None):
     print("> SCAN: {} -> {}".format(scan_root, output))
-    project = load_project(scan_root, file_exclusions=file_exclusions, dir_exclusions=dir_exclusions)
+    cached_project = load_cached_project(output) if reuse_digests else None
+    try:
+        cached_nodes = cached_project.nodes if cached_project is not None else None
+        project = load_project(scan_root, file_exclusions=file_exclusions, dir_exclusions=dir_exclusions, cached_nodes=cached_nodes,
+            hasher=hasher, progress=progress)
+    finally:
+        if cached_project is not None:
+            cached_project.close()
     project.write(output)
 
 
+def fingerprint_of_file(path):
+    m = hashlib.sha1()
+    with io.open(path, mode='rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            m.update(chunk)
+    return m.hexdigest()
+
+
+def fingerprint_of_tree(scan_root, m):
+    # Directories are entries of their own, a release adding or removing only an empty one is another release.
+    for dir_path, dir_names, file_names in os.walk(scan_root):
+        dir_names.sort()
+        rel_dir = os.path.relpath(dir_path, scan_root).replace(os.sep, '/')
+        m.update(_to_utf8('{}\0{}\n'.format(rel_dir, TYPE_DIR)))
+        for name in sorted(file_names):
+            size, mtime_ns, _ = stat_key_of(os.stat(os.path.join(dir_path, name)))
+            m.update(_to_utf8('{}/{}\0{}\0{}\0{}\n'.format(rel_dir, name, TYPE_FILE, size, mtime_ns)))
+
+
+def release_fingerprint(config, scan_root, tarball):
+    # Identity of a pristine vendor release: the hash of its source tarball when one is configured,
+    # otherwise a hash of the names, sizes and mtimes in the sanitized tree, so no file is read.
+    # Everything that shapes the state file is part of it as well.
+    m = hashlib.sha1()
+    m.update(_to_utf8('{}\0{}\n'.format(DIGEST_ALGORITHM, STATE_FORMAT)))
+    for option in (TAG_DIRS_EXCLUDE_BY_FULL_PATH, TAG_FILES_EXCLUDE_BY_FULL_PATH):
+        m.update(_to_utf8('\0'.join(sorted(get_conf_strings_optional(config, TAG_SANITIZE, option))) + '\n'))
+    if tarball:
+        m.update(_to_utf8('tarball\0{}\n'.format(fingerprint_of_file(tarball))))
+    else:
+        fingerprint_of_tree(scan_root, m)
+    return m.hexdigest()
+
+
+def copy_file_atomic(src, dst):
+    tmp_dst = dst + '.tmp'
+    shutil.copyfile(src, tmp_dst)
+    replace_file(tmp_dst, dst)
+
+
+def scan_vendor_project(config, scan_root, output, tarball_option, hasher=None, progress=None):
+    digest_cache_dir = get_conf_string0(config, TAG_CONFIG, TAG_DIR_DIGEST_CACHE)
+    if not digest_cache_dir:
+        scan_project(scan_root, output, hasher=hasher, progress=progress)
+        return
+    digest_cache_dir = get_os_path_from_config(config, TAG_CONFIG, TAG_DIR_DIGEST_CACHE, DIR_HOME)
+    tarball = None
+    if config.has_option(TAG_CONFIG, tarball_option):
+        tarball = get_os_path_from_config(config, TAG_CONFIG, tarball_option, DIR_HOME)
+    cached_state = os.path.join(digest_cache_dir, '{}.state'.format(release_fingerprint(config, scan_root, tarball)))
+    if os.path.exists(cached_state):
+        print("> SCAN: {} -> {}, reused {}".format(scan_root, output, cached_state))
+        copy_file_atomic(cached_state, output)
+        return
+    scan_project(scan_root, output, hasher=hasher, progress=progress)
+    if not os.path.exists(digest_cache_dir):
+        os.makedirs(digest_cache_dir)
+    copy_file_atomic(output, cached_state)
+
+
+SCAN_PROGRESS_SECONDS = 2.0
+
+
+def get_scan_jobs(config):
+    jobs = int(get_conf_string0(config, TAG_CONFIG, TAG_SCAN_JOBS) or multiprocessing.cpu_count())
+    if jobs < 1:
+        raise Exception("Number of jobs has to be positive, got {}.".format(jobs))
+    return jobs
+
+
+def run_scans(scans, jobs):
+    # The trees are walked concurrently, each from its own thread, and hashed by one pool of `jobs` workers
+    # that is split evenly between them.
+    pool = HashingPool(jobs)
+    budget = max(1, jobs // max(1, len(scans)))
+    progresses = []
+    failures = []
+    threads = []
+
+    def run_scan(progress, func, args, kwargs):
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            sys.stdout.flush()
+            traceback.print_exc()
+            failures.append(progress.name)
+        finally:
+            progress.finish()
+
+    try:
+        for name, func, args, kwargs in scans:
+            progress = ScanProgress(name)
+            kwargs = dict(kwargs, hasher=PooledHasher(pool, budget, progress), progress=progress)
+            thread = threading.Thread(target=run_scan, args=(progress, func, args, kwargs))
+            thread.daemon = True
+            thread.start()
+            progresses.append(progress)
+            threads.append(thread)
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(SCAN_PROGRESS_SECONDS)
+                if thread.is_alive():
+                    print("> SCAN progress: {}".format(' | '.join(str(p) for p in progresses)))
+    finally:
+        pool.close()
+    for progress in progresses:
+        print("> SCAN done: {}".format(progress))
+    if failures:
+        raise Exception("Scanning failed for: {}.".format(', '.join(failures)))
+
+
 def gen_states(config):
     ensure_repo_sanitized(config)
 
@@ -534,9 +1304,11 @@ def gen_states(config):
     sanitize_project(dir_from)
     sanitize_project(dir_to)
 
-    scan_project(dir_from, state_file_from)
-    scan_project(dir_to, state_file_to)
-    scan_project(dir_repo, state_file_repo, file_exclusions=repo_file_exclusions, dir_exclusions=repo_dir_exclusions)
+    run_scans([ ('from', scan_vendor_project, (config, dir_from, state_file_from, TAG_TARBALL_FROM), {}),
+                ('to', scan_vendor_project, (config, dir_to, state_file_to, TAG_TARBALL_TO), {}),
+                ('repo', scan_project, (dir_repo, state_file_repo),
+                    {'file_exclusions': repo_file_exclusions, 'dir_exclusions': repo_dir_exclusions, 'reuse_digests': True}) ],
+        get_scan_jobs(config))
 
 
 def report_projects_diff(project_old, project_new):
@@ -586,55 +1358,69 @@ def ensure_only_file_modifications(changes):
     exit(1)
 
 
-def lookup_for_conflicts(repo_changes, vendor_changes):
-    conflicts = []
-    markers = set()
-    for chset in repo_changes:
-        markers.add(chset.archive_path)
-    for chset in vendor_changes:
-        if chset.archive_path in markers:
-            conflicts.append(chset.archive_path)
-    return conflicts
+class ChangeIndex:
+    # Change sets bucketed by (item type, flags) in one pass, each bucket keeps the diff order,
+    # so the lookups below select whole buckets instead of rescanning all the changes.
+    def __init__(self, changes):
+        self._buckets = {}
+        self._positions = {}
+        for i, chset in enumerate(changes):
+            key = (chset.item_type, chset.flags)
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = []
+                self._buckets[key] = bucket
+            bucket.append(chset)
+            self._positions.setdefault(chset.archive_path, []).append(i)
+
+    def keys(self):
+        return self._buckets.keys()
+
+    def changes_of(self, item_type, flags):
+        return self._buckets.get((item_type, flags), [])
 
+    def paths_of(self, item_type, flags, excluded=None):
+        if not excluded:
+            return [chset.archive_path for chset in self.changes_of(item_type, flags)]
+        return [chset.archive_path for chset in self.changes_of(item_type, flags) if chset.archive_path not in excluded]
 
-def lookup_for_added_directories(vendor_changes):
-    added_dirs = []
-    for chset in vendor_changes:
-        if chset.flags == CHANGE_STATUS_ITEM_ADDED | CHANGE_STATUS_SEEDING:
-            added_dirs.append(chset.archive_path)
-    return added_dirs
+    def paths_in(self, paths):
+        # Changes on any of the paths, in the diff order.
+        found = []
+        for path in paths:
+            for i in self._positions.get(path, []):
+                found.append((i, path))
+        found.sort()
+        return [path for _, path in found]
 
 
-def lookup_for_deleted_directories(vendor_changes):
-    deleted_dirs = []
-    for chset in vendor_changes:
-        if chset.flags == CHANGE_STATUS_ITEM_DELETED | CHANGE_STATUS_SEEDING:
-            deleted_dirs.append(chset.archive_path)
-    return deleted_dirs
+def lookup_for_conflicts(index, conflicting_paths):
+    return index.paths_in(conflicting_paths)
 
 
-def lookup_for_simple_modifications(vendor_changes, conflicting_files):
-    added_files = []
-    deleted_files = []
-    modified_files = []
+def lookup_for_added_directories(index):
+    return index.paths_of(TYPE_DIR, CHANGE_STATUS_ITEM_ADDED | CHANGE_STATUS_SEEDING)
 
-    for chset in vendor_changes:
-        if chset.archive_path in conflicting_files:
+
+def lookup_for_deleted_directories(index):
+    return index.paths_of(TYPE_DIR, CHANGE_STATUS_ITEM_DELETED | CHANGE_STATUS_SEEDING)
+
+
+def lookup_for_simple_modifications(index, conflicting_files):
+    conflicting_files = set(conflicting_files)
+    simple_flags = (CHANGE_STATUS_ITEM_ADDED, CHANGE_STATUS_ITEM_DELETED, CHANGE_STATUS_ITEM_MODIFIED)
+    for item_type, flags in index.keys():
+        if flags & (CHANGE_STATUS_INHERITED | CHANGE_STATUS_SEEDING):
             continue
-        if chset.flags & (CHANGE_STATUS_INHERITED | CHANGE_STATUS_SEEDING):
+        if item_type == TYPE_FILE and flags in simple_flags:
             continue
-        if chset.item_type != TYPE_FILE:
-            raise Exception("Unexpected simple modification: '{}'".format(chset))
-
-        if chset.flags == CHANGE_STATUS_ITEM_ADDED:
-            added_files.append(chset.archive_path)
-        elif chset.flags == CHANGE_STATUS_ITEM_DELETED:
-            deleted_files.append(chset.archive_path)
-        elif chset.flags == CHANGE_STATUS_ITEM_MODIFIED:
-            modified_files.append(chset.archive_path)
-        else:
-            raise Exception("Unexpected simple modification: '{}'".format(chset))
+        for chset in index.changes_of(item_type, flags):
+            if chset.archive_path not in conflicting_files:
+                raise Exception("Unexpected simple modification: '{}'".format(chset))
 
+    added_files = index.paths_of(TYPE_FILE, CHANGE_STATUS_ITEM_ADDED, conflicting_files)
+    deleted_files = index.paths_of(TYPE_FILE, CHANGE_STATUS_ITEM_DELETED, conflicting_files)
+    modified_files = index.paths_of(TYPE_FILE, CHANGE_STATUS_ITEM_MODIFIED, conflicting_files)
     return added_files, deleted_files, modified_files
 
 
@@ -644,15 +1430,453 @@ TAG_UPGRADE_REPORT_DELETED_DIRECTORIES = 'deleted-directories'
 TAG_UPGRADE_REPORT_ADDED_FILES = 'added-files'
 TAG_UPGRADE_REPORT_DELETED_FILES = 'deleted-files'
 TAG_UPGRADE_REPORT_MODIFIED_FILES = 'modified-files'
+UPGRADE_REPORT_GROUPS = [ TAG_UPGRADE_REPORT_CONFLICTING_FILES, TAG_UPGRADE_REPORT_ADDED_DIRECTORIES, TAG_UPGRADE_REPORT_DELETED_DIRECTORIES,
+                          TAG_UPGRADE_REPORT_ADDED_FILES, TAG_UPGRADE_REPORT_DELETED_FILES, TAG_UPGRADE_REPORT_MODIFIED_FILES ]
+
+EXECUTOR_IN_PROCESS = 'in-process'
+EXECUTOR_EXTERNAL = 'external'
+EXECUTORS = [EXECUTOR_IN_PROCESS, EXECUTOR_EXTERNAL]
+
+# Scripts exposing make_parser() and main(args, context), so a command running one of them
+# with this very interpreter can be served without starting a new process per item.
+IN_PROCESS_SCRIPTS = ['delete.py', 'dir-add.py', 'file-add.py', 'file-copy.py', 'resolve_conflict.py']
 
-class UpgradeState:
+
+def split_command_line(cmdline):
+    posix = (os.name != 'nt')
+    argv = shlex.split(cmdline, posix=posix)
+    if not posix:
+        argv = [arg[1:-1] if len(arg) > 1 and arg[0] == arg[-1] == '"' else arg for arg in argv]
+    return argv
+
+
+def is_same_path(a, b):
+    return os.path.normcase(os.path.abspath(a)) == os.path.normcase(os.path.abspath(b))
+
+
+def load_script_module(script_path):
+    module_name = '_upgrade_' + os.path.splitext(os.path.basename(script_path))[0].replace('-', '_')
+    script_dir = os.path.dirname(script_path)
+    if script_dir not in sys.path:
+        sys.path.insert(0, script_dir)
+    if sys.version_info[0] < 3:
+        import imp
+        return imp.load_source(module_name, script_path)
+    import importlib.util
+    spec = importlib.util.spec_from_file_location(module_name, script_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class ExternalCommand(object):
+    def __init__(self, cmdline):
+        self.cmdline = cmdline
+
+    def __call__(self, item):
+        per_item_cmd = self.cmdline.format(item)
+        print("exec: {}".format(per_item_cmd))
+        print(80 * '-')
+        ret = subprocess.call(per_item_cmd)
+        print(80 * '-')
+        return ret
+
+
+class InProcessCommand(object):
+    def __init__(self, cmdline, module, argv, context):
+        self.cmdline = cmdline
+        self.module = module
+        self.argv = argv
+        self.context = context
+        self.parser = module.make_parser()
+
+    def __call__(self, item):
+        print("exec: {}".format(self.cmdline.format(item)))
+        print(80 * '-')
+        try:
+            self.module.main(self.parser.parse_args([arg.format(item) for arg in self.argv]), self.context)
+            ret = 0
+        except SystemExit as e:
+            ret = e.code if isinstance(e.code, int) else int(e.code is not None)
+        except Exception:
+            sys.stdout.flush()
+            traceback.print_exc()
+            sys.stderr.flush()
+            ret = 1
+        print(80 * '-')
+        return ret
+
+
+class CommandExecutors:
+    def __init__(self, executor=EXECUTOR_IN_PROCESS):
+        if executor not in EXECUTORS:
+            raise Exception("Unknown executor '{}', expected one of: {}.".format(executor, ', '.join(EXECUTORS)))
+        self.executor = executor
+        self.context = {}
+        self._modules = {}
+
+    def make_command(self, cmdline):
+        if cmdline is None:
+            return None
+        if self.executor == EXECUTOR_IN_PROCESS:
+            argv = split_command_line(cmdline)
+            if len(argv) >= 2 and is_same_path(argv[0], sys.executable) and os.path.basename(argv[1]) in IN_PROCESS_SCRIPTS:
+                return InProcessCommand(cmdline, self._load(argv[1]), argv[2:], self.context)
+        return ExternalCommand(cmdline)
+
+    def _load(self, script_path):
+        script_path = os.path.normcase(os.path.abspath(script_path))
+        module = self._modules.get(script_path)
+        if module is None:
+            module = load_script_module(script_path)
+            self._modules[script_path] = module
+        return module
+
+
+def load_command_executors(config):
+    executor = get_conf_string0(config, TAG_COMMANDS, TAG_CMD_EXECUTOR) or EXECUTOR_IN_PROCESS
+    return CommandExecutors(executor)
+
+
+def get_apply_jobs(config):
+    jobs = int(get_conf_string0(config, TAG_COMMANDS, TAG_CMD_JOBS) or 1)
+    if jobs < 1:
+        raise Exception("Number of jobs has to be positive, got {}.".format(jobs))
+    return jobs
+
+
+class ApplyStep(object):
+    __slots__ = ('index', 'group', 'cmd', 'item', 'blockers', 'dependents')
+
+    def __init__(self, index, group, cmd, item):
+        self.index = index
+        self.group = group
+        self.cmd = cmd
+        self.item = item
+        self.blockers = 0
+        self.dependents = []
+
+
+def make_apply_steps(groups, processed_items, done_groups):
+    # Two steps depend on each other when one path equals or contains the other:
+    # they then keep the order of the groups, anything else may run in any order.
+    steps = []
+    steps_by_path = {}
+    for group, cmd, items in groups:
+        if cmd is None:
+            continue
+        if group in done_groups:
+            print(80 * '-')
+            print("{} - skipped, already processed".format(group))
+            print(80 * '-')
+            continue
+        for item in items:
+            if item in processed_items:
+                print(80 * '-')
+                print("{} - skipped, already processed".format(item))
+                print(80 * '-')
+                continue
+            step = ApplyStep(len(steps), group, cmd, item)
+            steps.append(step)
+            steps_by_path.setdefault(item, []).append(step)
+    for step in steps:
+        bits = step.item.split('/')
+        for depth in range(1, len(bits) + 1):
+            path = '/'.join(bits[:depth])
+            for other in steps_by_path.get(path, ()):
+                if other is step or (depth == len(bits) and other.index > step.index):
+                    continue
+                first, second = (other, step) if other.index < step.index else (step, other)
+                first.dependents.append(second)
+                second.blockers += 1
+    return steps
+
+
+def run_apply_step(step):
+    try:
+        return step.cmd(step.item)
+    except Exception:
+        sys.stdout.flush()
+        traceback.print_exc()
+        sys.stderr.flush()
+        return 1
+
+
+def apply_steps_worker(inbox, outbox):
+    while True:
+        step = inbox.get()
+        if step is None:
+            return
+        outbox.put((step, run_apply_step(step)))
+
+
+def run_apply_steps(steps, jobs, on_done):
+    # Ready steps are taken in their group order, so a single job replays the groups one by one.
+    ready = [(step.index, step) for step in steps if step.blockers == 0]
+    heapq.heapify(ready)
+    inbox = queue.Queue()
+    outbox = queue.Queue()
+    workers = []
+    if jobs > 1:
+        for _ in range(jobs):
+            worker = threading.Thread(target=apply_steps_worker, args=(inbox, outbox))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+    in_flight = 0
+    failed = False
+    while True:
+        while ready and in_flight < jobs and not failed:
+            _, step = heapq.heappop(ready)
+            if workers:
+                inbox.put(step)
+            else:
+                outbox.put((step, run_apply_step(step)))
+            in_flight += 1
+        if not in_flight:
+            break
+        step, ret = outbox.get()
+        in_flight -= 1
+        if ret != 0:
+            # let the steps in flight finish and record them, but start nothing new
+            failed = True
+            continue
+        on_done(step)
+        for dependent in step.dependents:
+            dependent.blockers -= 1
+            if not dependent.blockers:
+                heapq.heappush(ready, (dependent.index, dependent))
+    for _ in workers:
+        inbox.put(None)
+    for worker in workers:
+        worker.join()
+    return not failed
+
+
+DEFAULT_PROGRESS_SYNC_ITEMS = 256
+DEFAULT_PROGRESS_SYNC_MS = 1000
+PROGRESS_GROUP_DONE = '#done '
+
+
+class ProgressJournal:
+    # Append-only log of processed items, one per line as the cache files always were, plus
+    # a '#done <group>' line once a whole group is through. The file stays open for the run and
+    # lines are committed (flushed and fsync-ed) in batches: after sync_items lines or sync_ms
+    # milliseconds, whichever comes first, 0 turns a limit off. Lines lost with a crashed batch
+    # only make a rerun repeat those items, and every command applied here can be repeated.
+    def __init__(self, filename, sync_items=DEFAULT_PROGRESS_SYNC_ITEMS, sync_ms=DEFAULT_PROGRESS_SYNC_MS):
+        self.filename = filename
+        self.sync_items = sync_items
+        self.sync_ms = sync_ms
+        self.processed_items = set()
+        self.done_groups = set()
+        self._file = None
+        self._pending = 0
+        self._synced_at = 0
+
+    def load(self):
+        if not os.path.exists(self.filename):
+            return
+        with io.open(self.filename, mode='rt', encoding='utf8') as journal:
+            for line in journal:
+                entry = line.rstrip('\n').strip()
+                if not entry:
+                    continue
+                if entry.startswith(PROGRESS_GROUP_DONE):
+                    self.done_groups.add(entry[len(PROGRESS_GROUP_DONE):])
+                else:
+                    self.processed_items.add(entry)
+
+    def compact(self, groups):
+        # Items of finished groups aren't looked at again, the next load doesn't have to read them.
+        if not self.done_groups:
+            return
+        needed = set()
+        for group, items in groups:
+            if group not in self.done_groups:
+                needed.update(item for item in items if item in self.processed_items)
+        if len(needed) == len(self.processed_items):
+            return
+        self.processed_items = needed
+        tmp_filename = self.filename + '.tmp'
+        with io.open(tmp_filename, mode='wt', encoding='utf8') as journal:
+            for group in sorted(self.done_groups):
+                journal.writelines([_to_string(PROGRESS_GROUP_DONE), _to_string(group), _to_string('\n')])
+            for item in sorted(needed):
+                journal.writelines([_to_string(item), _to_string('\n')])
+            journal.flush()
+            os.fsync(journal.fileno())
+        replace_file(tmp_filename, self.filename)
+
+    def open(self):
+        self._file = io.open(self.filename, mode='at', encoding='utf8')
+        self._synced_at = time.time()
+
+    def add_item(self, item):
+        self._append(item)
+
+    def add_done_group(self, group):
+        self.done_groups.add(group)
+        self._append(PROGRESS_GROUP_DONE + group)
+        self.commit()
+
+    def commit(self):
+        if not self._pending:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._pending = 0
+        self._synced_at = time.time()
+
+    def close(self):
+        if self._file is None:
+            return
+        self.commit()
+        self._file.close()
+        self._file = None
+
+    def _append(self, entry):
+        self._file.writelines([_to_string(entry), _to_string('\n')])
+        self._pending += 1
+        if self.sync_items and self._pending >= self.sync_items:
+            self.commit()
+        elif self.sync_ms and (time.time() - self._synced_at) * 1000 >= self.sync_ms:
+            self.commit()
+
+
+def load_progress_journal(config, filename):
+    sync_items = int(get_conf_string0(config, TAG_CONFIG, TAG_PROGRESS_SYNC_ITEMS) or DEFAULT_PROGRESS_SYNC_ITEMS)
+    sync_ms = int(get_conf_string0(config, TAG_CONFIG, TAG_PROGRESS_SYNC_MS) or DEFAULT_PROGRESS_SYNC_MS)
+    journal = ProgressJournal(filename, sync_items=sync_items, sync_ms=sync_ms)
+    journal.load()
+    return journal
+
+
+UPGRADE_REPORT_HEADER = '# upgrade-report: 1'
+UPGRADE_REPORT_CHUNK_SIZE = 64 * 1024
+# group, offset and size of its items in bytes, number of items
+_UPGRADE_REPORT_TABLE_LINE = '{} {:016d} {:016d} {:016d}\n'
+
+
+def write_sectioned_report(filename, groups):
+    # Layout: the header line, one offset table line per group and an empty line,
+    # then every group as a '[name]' line followed by its items, one per line.
+    header = _to_utf8(UPGRADE_REPORT_HEADER + '\n')
+    sections = []
+    for group, items in groups:
+        body = b''.join(_to_utf8(item) + b'\n' for item in items)
+        sections.append((group, _to_utf8('[{}]\n'.format(group)), body, len(items)))
+    position = len(header) + 1
+    for group, _, _, _ in sections:
+        position += len(_to_utf8(_UPGRADE_REPORT_TABLE_LINE.format(group, 0, 0, 0)))
+    table = []
+    for group, title, body, count in sections:
+        position += len(title)
+        table.append(_to_utf8(_UPGRADE_REPORT_TABLE_LINE.format(group, position, len(body), count)))
+        position += len(body)
+    tmp_filename = filename + '.tmp'
+    with io.open(tmp_filename, mode='wb') as f:
+        f.write(header)
+        f.write(b''.join(table))
+        f.write(b'\n')
+        for _, title, body, _ in sections:
+            f.write(title)
+            f.write(body)
+        f.flush()
+        os.fsync(f.fileno())
+    replace_file(tmp_filename, filename)
+
+
+class SectionedReport:
+    # Only the offset table is read up front, every group is streamed on its own when asked for.
+    def __init__(self, filename):
+        self.filename = filename
+        self._sections = {}
+        with io.open(filename, mode='rb') as f:
+            if f.readline().rstrip(b'\r\n') != _to_utf8(UPGRADE_REPORT_HEADER):
+                raise Exception("Report file '{}' isn't a sectioned report.".format(filename))
+            while True:
+                line = f.readline().rstrip(b'\r\n')
+                if not line:
+                    break
+                group, offset, size, count = line.decode('utf-8').split(' ')
+                self._sections[group] = (int(offset), int(size), int(count))
+
+    @staticmethod
+    def is_sectioned(filename):
+        header = _to_utf8(UPGRADE_REPORT_HEADER)
+        with io.open(filename, mode='rb') as f:
+            return f.read(len(header)) == header
+
+    def count(self, group):
+        return self._section(group)[2]
+
+    def iter_items(self, group):
+        offset, size, _ = self._section(group)
+        with io.open(self.filename, mode='rb') as f:
+            f.seek(offset)
+            tail = b''
+            while size > 0:
+                chunk = f.read(min(size, UPGRADE_REPORT_CHUNK_SIZE))
+                if not chunk:
+                    raise Exception("Report file '{}' is truncated in group '{}'.".format(self.filename, group))
+                size -= len(chunk)
+                lines = (tail + chunk).split(b'\n')
+                tail = lines.pop()
+                for line in lines:
+                    yield line.decode('utf-8')
+
+    def read_group(self, group):
+        return list(self.iter_items(group))
+
+    def _section(self, group):
+        section = self._sections.get(group)
+        if section is None:
+            raise Exception("Report file '{}' has no '{}' group.".format(self.filename, group))
+        return section
+
+
+class UpgradeState(object):
     def __init__(self, conflicting_files, added_directories, deleted_directories, added_files, deleted_files, modified_files):
-        self.conflicting_files = conflicting_files
-        self.added_directories = added_directories
-        self.deleted_directories = deleted_directories
-        self.added_files = added_files
-        self.deleted_files = deleted_files
-        self.modified_files = modified_files
+        self._reader = None
+        self._items = { TAG_UPGRADE_REPORT_CONFLICTING_FILES: conflicting_files,
+                        TAG_UPGRADE_REPORT_ADDED_DIRECTORIES: added_directories,
+                        TAG_UPGRADE_REPORT_DELETED_DIRECTORIES: deleted_directories,
+                        TAG_UPGRADE_REPORT_ADDED_FILES: added_files,
+                        TAG_UPGRADE_REPORT_DELETED_FILES: deleted_files,
+                        TAG_UPGRADE_REPORT_MODIFIED_FILES: modified_files }
+
+    @property
+    def conflicting_files(self):
+        return self.items_of(TAG_UPGRADE_REPORT_CONFLICTING_FILES)
+
+    @property
+    def added_directories(self):
+        return self.items_of(TAG_UPGRADE_REPORT_ADDED_DIRECTORIES)
+
+    @property
+    def deleted_directories(self):
+        return self.items_of(TAG_UPGRADE_REPORT_DELETED_DIRECTORIES)
+
+    @property
+    def added_files(self):
+        return self.items_of(TAG_UPGRADE_REPORT_ADDED_FILES)
+
+    @property
+    def deleted_files(self):
+        return self.items_of(TAG_UPGRADE_REPORT_DELETED_FILES)
+
+    @property
+    def modified_files(self):
+        return self.items_of(TAG_UPGRADE_REPORT_MODIFIED_FILES)
+
+    def items_of(self, group):
+        # Groups of a sectioned report are read on first use.
+        items = self._items.get(group)
+        if items is None:
+            items = self._reader.read_group(group)
+            self._items[group] = items
+        return items
 
     def dump(self):
         self._dump_items('CONFLICTS', self.conflicting_files)
@@ -673,23 +1897,16 @@ class UpgradeState:
                 print('    {}'.format(value))
 
     def write(self, filename):
-        with io.open(filename, mode='wt', encoding='utf8') as f:
-            f.write(_to_string("{\n"))
-            for group_name, items in  [ (TAG_UPGRADE_REPORT_CONFLICTING_FILES, self.conflicting_files),
-                                        (TAG_UPGRADE_REPORT_ADDED_DIRECTORIES, self.added_directories),
-                                        (TAG_UPGRADE_REPORT_DELETED_DIRECTORIES, self.deleted_directories),
-                                        (TAG_UPGRADE_REPORT_ADDED_FILES, self.added_files),
-                                        (TAG_UPGRADE_REPORT_DELETED_FILES, self.deleted_files),
-                                        (TAG_UPGRADE_REPORT_MODIFIED_FILES, self.modified_files) ]:
-                f.writelines([_to_string("    '"), _to_string(group_name), _to_string("' :"), _to_string("\n")])
-                f.writelines([_to_string("    ["), _to_string("\n")])
-                for item in items:
-                    f.writelines([_to_string("        '"), _to_string(item), _to_string("',"), _to_string("\n")])
-                f.writelines([_to_string("    ],"), _to_string("\n")])
-            f.write(_to_string("}\n"))
+        write_sectioned_report(filename, self.groups())
 
     @staticmethod
     def load_from_file(filename):
+        if SectionedReport.is_sectioned(filename):
+            report = UpgradeState(None, None, None, None, None, None)
+            report._reader = SectionedReport(filename)
+            return report
+
+        # reports written before the sectioned format are a Python literal
         data = load_py_data(filename)
         conflicting_files    = data[TAG_UPGRADE_REPORT_CONFLICTING_FILES]
         added_directories    = data[TAG_UPGRADE_REPORT_ADDED_DIRECTORIES]
@@ -702,39 +1919,42 @@ class UpgradeState:
             added_files=added_files, deleted_files=deleted_files, modified_files=modified_files)
         return report
 
-    def apply_commands(self, cache_file, conflics_cmd=None, add_dir_cmd=None, del_dir_cmd=None, add_file_cmd=None, del_file_cmd=None, modify_file_cmd=None):
-        processed_items = set()
-        if os.path.exists(cache_file):
-            with io.open(cache_file, mode='rt', encoding='utf8') as cache:
-                for line in cache.readlines():
-                    entry = line.rstrip('\n').strip()
-                    if entry:
-                        processed_items.add(entry)
-    
-        for cmd, items in [ (conflics_cmd, self.conflicting_files),
-                            (add_dir_cmd, self.added_directories),
-                            (del_dir_cmd, self.deleted_directories),
-                            (add_file_cmd, self.added_files),
-                            (del_file_cmd, self.deleted_files),
-                            (modify_file_cmd, self.modified_files) ]:
-            if cmd is None:
-                continue
-            for item in items:
-                if item in processed_items:
-                    print(80 * '-')
-                    print("{} - skipped, already processed".format(item))
-                    print(80 * '-')
-                    continue
-                per_item_cmd = cmd.format(item)
-                print("exec: {}".format(per_item_cmd))
-                print(80 * '-')
-                ret = subprocess.call(per_item_cmd)
-                print(80 * '-')
-                if ret != 0:
-                    print("ABORTED.")
-                    exit(1)
-                with io.open(cache_file, mode='at', encoding='utf8') as cache:
-                    cache.writelines([_to_string(item), _to_string("\n")])
+    def groups(self):
+        return [ (TAG_UPGRADE_REPORT_CONFLICTING_FILES, self.conflicting_files),
+                 (TAG_UPGRADE_REPORT_ADDED_DIRECTORIES, self.added_directories),
+                 (TAG_UPGRADE_REPORT_DELETED_DIRECTORIES, self.deleted_directories),
+                 (TAG_UPGRADE_REPORT_ADDED_FILES, self.added_files),
+                 (TAG_UPGRADE_REPORT_DELETED_FILES, self.deleted_files),
+                 (TAG_UPGRADE_REPORT_MODIFIED_FILES, self.modified_files) ]
+
+    def apply_commands(self, journal, conflics_cmd=None, add_dir_cmd=None, del_dir_cmd=None, add_file_cmd=None, del_file_cmd=None, modify_file_cmd=None, jobs=1):
+        commands = [conflics_cmd, add_dir_cmd, del_dir_cmd, add_file_cmd, del_file_cmd, modify_file_cmd]
+        # groups without a command are neither applied nor journaled, so they are never loaded
+        groups = [(group, cmd, self.items_of(group)) for group, cmd in zip(UPGRADE_REPORT_GROUPS, commands) if cmd is not None]
+        journal.compact([(group, items) for group, _, items in groups])
+        steps = make_apply_steps(groups, journal.processed_items, journal.done_groups)
+
+        remaining = {}
+        for step in steps:
+            remaining[step.group] = remaining.get(step.group, 0) + 1
+
+        def on_done(step):
+            journal.add_item(step.item)
+            remaining[step.group] -= 1
+            if not remaining[step.group]:
+                journal.add_done_group(step.group)
+
+        journal.open()
+        try:
+            for group, cmd, _ in groups:
+                if cmd is not None and group not in journal.done_groups and group not in remaining:
+                    journal.add_done_group(group)
+            completed = run_apply_steps(steps, jobs, on_done)
+        finally:
+            journal.close()
+        if not completed:
+            print("ABORTED.")
+            exit(1)
 
 
 def make_upgrade_report(config):
@@ -753,15 +1973,14 @@ def make_upgrade_report(config):
     project_to = load_project_from_state_file(state_file_to)
     project_repo = load_project_from_state_file(state_file_repo)
 
-    repo_changes = eval_projects_diff(project_from, project_repo)
+    vendor_changes, repo_changes, conflicting_paths = eval_projects_diff3(project_from, project_to, project_repo)
     ensure_only_file_modifications(repo_changes)
 
-    vendor_changes = eval_projects_diff(project_from, project_to)
-
-    conflicting_files = lookup_for_conflicts(repo_changes, vendor_changes)
-    added_directories = lookup_for_added_directories(vendor_changes)
-    deleted_directories = lookup_for_deleted_directories(vendor_changes)
-    added_files, deleted_files, modified_files = lookup_for_simple_modifications(vendor_changes, conflicting_files)
+    index = ChangeIndex(vendor_changes)
+    conflicting_files = lookup_for_conflicts(index, conflicting_paths)
+    added_directories = lookup_for_added_directories(index)
+    deleted_directories = lookup_for_deleted_directories(index)
+    added_files, deleted_files, modified_files = lookup_for_simple_modifications(index, conflicting_files)
 
     report = UpgradeState(conflicting_files=conflicting_files, added_directories=added_directories, deleted_directories=deleted_directories,
         added_files=added_files, deleted_files=deleted_files, modified_files=modified_files)
@@ -796,11 +2015,22 @@ def resolve_conflits(config):
         'dir-repo': dir_repo, 'dir-work': conflicts_work_dir}
 
     resolve_conflict_cmd = resolve_conflict_cmd.format(**cmdkw)
-    executor.apply_commands(cache_file=conflicts_cache_file, conflics_cmd=resolve_conflict_cmd)
+    commands = load_command_executors(config)
+    journal = load_progress_journal(config, conflicts_cache_file)
+    executor.apply_commands(journal, conflics_cmd=commands.make_command(resolve_conflict_cmd), jobs=get_apply_jobs(config))
 
     print('> Conflicts resolving completed')
 
 
+# Commands applying the report groups, in the order of UPGRADE_REPORT_GROUPS.
+UPGRADE_COMMAND_TAGS = [ TAG_CMD_FILE_MODIFY_CONFLICTED, TAG_CMD_DIRECTORY_ADD, TAG_CMD_DIRECTORY_DELETE,
+                         TAG_CMD_FILE_ADD, TAG_CMD_FILE_DELETE, TAG_CMD_FILE_MODIFY ]
+
+
+def format_upgrade_commands(config, cmdkw):
+    return [get_conf_string1(config, TAG_COMMANDS, tag).format(**cmdkw) for tag in UPGRADE_COMMAND_TAGS]
+
+
 def do_upgrade(config):
     print("> Upgrade started ...")
     cache_dir = get_os_path_from_config(config, TAG_CONFIG, TAG_DIR_CACHE, DIR_HOME)
@@ -809,36 +2039,223 @@ def do_upgrade(config):
     executor = UpgradeState.load_from_file(report_file)
     print("> Using report file: {}".format(report_file))
 
-    add_dir_cmd = get_conf_string1(config, TAG_COMMANDS, TAG_CMD_DIRECTORY_ADD)
-    del_dir_cmd = get_conf_string1(config, TAG_COMMANDS, TAG_CMD_DIRECTORY_DELETE)
-    add_file_cmd = get_conf_string1(config, TAG_COMMANDS, TAG_CMD_FILE_ADD)
-    del_file_cmd = get_conf_string1(config, TAG_COMMANDS, TAG_CMD_FILE_DELETE)
-    modify_file_cmd = get_conf_string1(config, TAG_COMMANDS, TAG_CMD_FILE_MODIFY)
-    resolved_conflict_cmd = get_conf_string1(config, TAG_COMMANDS, TAG_CMD_FILE_MODIFY_CONFLICTED)
-
     conflicts_work_dir = os.path.join(cache_dir, get_conf_string1(config, TAG_CONFIG, TAG_DIR_CONFLITS_WORK))
     dir_vendor_new = get_os_path_from_config(config, TAG_CONFIG, TAG_DIR_TO, DIR_HOME)
     dir_repo = get_os_path_from_config(config, TAG_CONFIG, TAG_DIR_REPO, DIR_HOME)
     cache_dir = get_os_path_from_config(config, TAG_CONFIG, TAG_DIR_CACHE, DIR_HOME)
     upgrade_cache_file = os.path.join(cache_dir, get_conf_string1(config, TAG_CONFIG, TAG_UPGRADE_CACHE_FILE))
     print("> Using cache file: {}".format(upgrade_cache_file))
+    link_mode = get_conf_string0(config, TAG_CONFIG, TAG_LINK_MODE) or 'auto'
 
-    cmdkw = {'executable': sys.executable, 'dir-here': DIR_HOME, 'dir-conflicts': conflicts_work_dir, 'dir-from': dir_vendor_new, 'dir-to': dir_repo}
-    resolved_conflict_cmd = resolved_conflict_cmd.format(**cmdkw)
-    add_dir_cmd = add_dir_cmd.format(**cmdkw)
-    del_dir_cmd = del_dir_cmd.format(**cmdkw)
-    add_file_cmd = add_file_cmd.format(**cmdkw)
-    del_file_cmd = del_file_cmd.format(**cmdkw)
-    modify_file_cmd = modify_file_cmd.format(**cmdkw)
-    
-    executor.apply_commands(cache_file=upgrade_cache_file,
-        conflics_cmd=resolved_conflict_cmd,
-        add_dir_cmd=add_dir_cmd, del_dir_cmd=del_dir_cmd,
-        add_file_cmd=add_file_cmd, del_file_cmd=del_file_cmd, modify_file_cmd=modify_file_cmd)
+    cmdkw = {'executable': sys.executable, 'dir-here': DIR_HOME, 'dir-conflicts': conflicts_work_dir, 'dir-from': dir_vendor_new, 'dir-to': dir_repo,
+        'link-mode': link_mode}
+    resolved_conflict_cmd, add_dir_cmd, del_dir_cmd, add_file_cmd, del_file_cmd, modify_file_cmd = format_upgrade_commands(config, cmdkw)
+
+    commands = load_command_executors(config)
+    journal = load_progress_journal(config, upgrade_cache_file)
+    executor.apply_commands(journal,
+        conflics_cmd=commands.make_command(resolved_conflict_cmd),
+        add_dir_cmd=commands.make_command(add_dir_cmd), del_dir_cmd=commands.make_command(del_dir_cmd),
+        add_file_cmd=commands.make_command(add_file_cmd), del_file_cmd=commands.make_command(del_file_cmd),
+        modify_file_cmd=commands.make_command(modify_file_cmd), jobs=get_apply_jobs(config))
 
     print('> Upgrade completed')
 
 
+ESTIMATE_PROBE_REPEATS = 3
+ESTIMATE_PROBE_FILES = 16
+ESTIMATE_PROBE_LARGE_SIZE = 4 * 1024 * 1024
+
+# group: (items are directories, probe in the source tree, probe in the target tree, the bytes are moved)
+ESTIMATE_GROUP_PROBES = {
+    TAG_UPGRADE_REPORT_CONFLICTING_FILES:   (False, True, True, True),
+    TAG_UPGRADE_REPORT_ADDED_DIRECTORIES:   (True, True, False, True),
+    TAG_UPGRADE_REPORT_DELETED_DIRECTORIES: (True, False, True, False),
+    TAG_UPGRADE_REPORT_ADDED_FILES:         (False, True, False, True),
+    TAG_UPGRADE_REPORT_DELETED_FILES:       (False, False, True, False),
+    TAG_UPGRADE_REPORT_MODIFIED_FILES:      (False, True, True, True),
+}
+
+
+class GroupEstimate:
+    def __init__(self, group):
+        self.group = group
+        self.items = 0
+        self.files = 0
+        self.bytes = 0
+        self.dir_ops = 0
+        self.seconds = 0.0
+
+
+class CommandCost:
+    # Linear model of a command: a cost per item, per file beyond the first one of an item and per byte moved.
+    def __init__(self, per_item, per_file=0.0, per_byte=0.0):
+        self.per_item = per_item
+        self.per_file = per_file
+        self.per_byte = per_byte
+
+    def seconds_of(self, estimate):
+        extra_files = max(estimate.files - estimate.items, 0)
+        return estimate.items * self.per_item + extra_files * self.per_file + estimate.bytes * self.per_byte
+
+
+def size_of_state_file(state, root, key):
+    src = state.nodes.get(key)
+    if src is not None and src.stat is not None:
+        return src.stat[0]
+    path = os.path.join(root, key)
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return 0
+
+
+def measure_state_subtree(state, root, key, estimate, with_bytes):
+    for child in state.select_keys_of_children(key):
+        if state.nodes.get(child).src_type == TYPE_DIR:
+            estimate.dir_ops += 1
+            measure_state_subtree(state, root, child, estimate, with_bytes)
+        else:
+            estimate.files += 1
+            if with_bytes:
+                estimate.bytes += size_of_state_file(state, root, child)
+
+
+def make_probe(path, is_dir, files, size):
+    content = (b'probe line\n' * (size // 11 + 1))
+    if not is_dir:
+        with io.open(path, mode='wb') as f:
+            f.write(content[:size])
+        return
+    os.makedirs(path)
+    for i in range(files):
+        with io.open(os.path.join(path, 'f{}'.format(i)), mode='wb') as f:
+            f.write(content[:max(size // files, 1)])
+
+
+def time_probe(cmd, group, source_root, target_root, files, size):
+    # The best of a few runs, every one on a fresh subject.
+    is_dir, in_source, in_target, _ = ESTIMATE_GROUP_PROBES[group]
+    best = None
+    for attempt in range(ESTIMATE_PROBE_REPEATS):
+        name = 'probe-{}-{}-{}-{}'.format(group, files, size, attempt)
+        if in_source:
+            make_probe(os.path.join(source_root, name), is_dir, files, size)
+        if in_target:
+            make_probe(os.path.join(target_root, name), is_dir, files, size)
+        started = time.time()
+        ret = cmd(name)
+        elapsed = time.time() - started
+        if ret != 0:
+            raise Exception("Calibration run of '{}' failed with exit code {}.".format(cmd.cmdline.format(name), ret))
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def calibrate_command(cmd, group, source_root, target_root):
+    is_dir, _, _, moves_bytes = ESTIMATE_GROUP_PROBES[group]
+    per_item = time_probe(cmd, group, source_root, target_root, 1, 1)
+    per_file = 0.0
+    per_byte = 0.0
+    if is_dir:
+        many = time_probe(cmd, group, source_root, target_root, ESTIMATE_PROBE_FILES, ESTIMATE_PROBE_FILES)
+        per_file = max(many - per_item, 0.0) / (ESTIMATE_PROBE_FILES - 1)
+    if moves_bytes:
+        large = time_probe(cmd, group, source_root, target_root, 1, ESTIMATE_PROBE_LARGE_SIZE)
+        per_byte = max(large - per_item, 0.0) / ESTIMATE_PROBE_LARGE_SIZE
+    return CommandCost(per_item, per_file, per_byte)
+
+
+def format_size(size):
+    if size < 1024:
+        return '{} B'.format(size)
+    for unit in ['KB', 'MB', 'GB']:
+        size /= 1024.0
+        if size < 1024 or unit == 'GB':
+            return '{:.1f} {}'.format(size, unit)
+
+
+def estimate_upgrade(config):
+    print("> Estimate upgrade ...")
+    cache_dir = get_os_path_from_config(config, TAG_CONFIG, TAG_DIR_CACHE, DIR_HOME)
+    report_file = os.path.join(cache_dir, get_conf_string1(config, TAG_CONFIG, TAG_UPGRADE_REPORT_FILE))
+    report = UpgradeState.load_from_file(report_file)
+    print("> Using report file: {}".format(report_file))
+
+    conflicts_work_dir = os.path.join(cache_dir, get_conf_string1(config, TAG_CONFIG, TAG_DIR_CONFLITS_WORK))
+    dir_vendor_new = get_os_path_from_config(config, TAG_CONFIG, TAG_DIR_TO, DIR_HOME)
+    dir_repo = get_os_path_from_config(config, TAG_CONFIG, TAG_DIR_REPO, DIR_HOME)
+    project_to = load_project_from_state_file(os.path.join(cache_dir, get_conf_string1(config, TAG_CONFIG, TAG_STATE_FILE_TO)))
+    project_repo = load_project_from_state_file(os.path.join(cache_dir, get_conf_string1(config, TAG_CONFIG, TAG_STATE_FILE_REPO)))
+    # items an interrupted upgrade has already applied aren't counted
+    journal = load_progress_journal(config, os.path.join(cache_dir, get_conf_string1(config, TAG_CONFIG, TAG_UPGRADE_CACHE_FILE)))
+
+    estimates = []
+    for group, items in report.groups():
+        estimate = GroupEstimate(group)
+        estimates.append(estimate)
+        if group in journal.done_groups:
+            continue
+        for item in items:
+            if item in journal.processed_items:
+                continue
+            estimate.items += 1
+            if group == TAG_UPGRADE_REPORT_CONFLICTING_FILES:
+                estimate.files += 1
+                resolved = os.path.join(conflicts_work_dir, item)
+                if os.path.isfile(resolved):
+                    estimate.bytes += os.path.getsize(resolved)
+                else:
+                    estimate.bytes += size_of_state_file(project_to, dir_vendor_new, item)
+            elif group == TAG_UPGRADE_REPORT_ADDED_DIRECTORIES:
+                estimate.dir_ops += 1
+                measure_state_subtree(project_to, dir_vendor_new, item, estimate, True)
+            elif group == TAG_UPGRADE_REPORT_DELETED_DIRECTORIES:
+                estimate.dir_ops += 1
+                measure_state_subtree(project_repo, dir_repo, item, estimate, False)
+            elif group == TAG_UPGRADE_REPORT_DELETED_FILES:
+                estimate.files += 1
+            else:
+                estimate.files += 1
+                estimate.bytes += size_of_state_file(project_to, dir_vendor_new, item)
+
+    # The configured commands are timed on probe files in a scratch directory, never on the repo.
+    probe_root = tempfile.mkdtemp(prefix='estimate-', dir=cache_dir)
+    try:
+        source_root = os.path.join(probe_root, 'source')
+        target_root = os.path.join(probe_root, 'target')
+        os.makedirs(source_root)
+        os.makedirs(target_root)
+        cmdkw = {'executable': sys.executable, 'dir-here': DIR_HOME, 'dir-conflicts': source_root, 'dir-from': source_root, 'dir-to': target_root,
+            'link-mode': get_conf_string0(config, TAG_CONFIG, TAG_LINK_MODE) or 'auto'}
+        commands = load_command_executors(config)
+        for estimate, cmdline in zip(estimates, format_upgrade_commands(config, cmdkw)):
+            if estimate.items:
+                print("> Calibrating '{}' ...".format(estimate.group))
+                estimate.seconds = calibrate_command(commands.make_command(cmdline), estimate.group, source_root, target_root).seconds_of(estimate)
+    finally:
+        shutil.rmtree(probe_root, ignore_errors=True)
+
+    print(80 * '-')
+    print('ESTIMATE')
+    print(80 * '-')
+    print('  {:<22}{:>8}{:>9}{:>13}{:>9}{:>12}'.format('group', 'items', 'files', 'bytes', 'dir ops', 'seconds'))
+    for e in estimates:
+        print('  {:<22}{:>8}{:>9}{:>13}{:>9}{:>12.3f}'.format(e.group, e.items, e.files, format_size(e.bytes), e.dir_ops, e.seconds))
+    total_seconds = sum(e.seconds for e in estimates)
+    total_bytes = sum(e.bytes for e in estimates)
+    print(80 * '-')
+    print("> Bytes to add or copy: {}".format(format_size(total_bytes)))
+    print("> Directory operations: {}".format(sum(e.dir_ops for e in estimates)))
+    print("> Predicted wall time: {:.2f} s".format(total_seconds))
+    jobs = get_apply_jobs(config)
+    if jobs > 1:
+        print("> Predicted wall time with {} jobs: {:.2f} s at best, nested items still run one after another".format(jobs, total_seconds / jobs))
+    if total_seconds > 0:
+        dominant = max(estimates, key=lambda e: e.seconds)
+        print("> Dominant group: '{}', {:.0%} of the time".format(dominant.group, dominant.seconds / total_seconds))
+
+
 # ============================================================================================================================
 # ============================================================================================================================
 # ============================================================================================================================
@@ -850,6 +2267,7 @@ TAG_RUN_MODE_DIFF_REPO = 'diff-repo'
 TAG_RUN_MODE_UPGRADE_REPORT = 'make-upgrade-report'
 TAG_RUN_MODE_UPGRADE = 'upgrade'
 TAG_RUN_MODE_RESOLVE_CONFLITS = 'resolve-conflicts'
+TAG_RUN_MODE_ESTIMATE = 'estimate'
 
 
 RUN_MODES = [
@@ -858,6 +2276,7 @@ RUN_MODES = [
   TAG_RUN_MODE_DIFF_REPO,
   TAG_RUN_MODE_UPGRADE_REPORT,
   TAG_RUN_MODE_RESOLVE_CONFLITS,
+  TAG_RUN_MODE_ESTIMATE,
   TAG_RUN_MODE_UPGRADE,
 ]
 
@@ -867,6 +2286,7 @@ RUN_MAPPING = {
   TAG_RUN_MODE_DIFF_REPO: report_diff_repo,
   TAG_RUN_MODE_UPGRADE_REPORT: make_upgrade_report,
   TAG_RUN_MODE_RESOLVE_CONFLITS: resolve_conflits,
+  TAG_RUN_MODE_ESTIMATE: estimate_upgrade,
   TAG_RUN_MODE_UPGRADE: do_upgrade,
 }
 
@@ -875,7 +2295,11 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--config', required=True)
     parser.add_argument('--mode', required=True, choices=RUN_MODES)
+    parser.add_argument('--jobs', type=int)
     args = parser.parse_args()
     config = load_config(args.config)
+    if args.jobs is not None:
+        config.set(TAG_CONFIG, TAG_SCAN_JOBS, str(args.jobs))
+        config.set(TAG_COMMANDS, TAG_CMD_JOBS, str(args.jobs))
     run_func = RUN_MAPPING[args.mode]
     run_func(config)